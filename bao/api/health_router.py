@@ -0,0 +1,40 @@
+from typing import Dict
+
+from fastapi import APIRouter, Request, Response
+from pydantic import BaseModel, Field
+
+from bao.components.chains.answer_cache_chain import AnswerCaching
+from bao.components.vectordb import QdrantVectorDB
+from bao.settings.settings import Settings
+
+health_router = APIRouter(prefix="/health")
+
+
+class HealthResponse(BaseModel):
+    status: str = Field(description="'ok' when the service can take traffic")
+
+
+@health_router.get("", tags=["Health"])
+def health() -> HealthResponse:
+    """Liveness probe"""
+    return HealthResponse(status="ok")
+
+
+@health_router.get("/ready", tags=["Health"])
+def ready(request: Request, response: Response) -> HealthResponse:
+    """Readiness probe. Ready once the embedding model is loaded and warmed up."""
+    settings: Settings = request.state.injector.get(Settings)
+    db: QdrantVectorDB = request.state.injector.get(QdrantVectorDB)
+    if settings.embedding.warmup_on_startup and not db.embeddings.is_ready:  # type: ignore
+        response.status_code = 503
+        return HealthResponse(status="warming up")
+    return HealthResponse(status="ok")
+
+
+@health_router.get("/answer_cache", tags=["Health"])
+def answer_cache_stats(request: Request) -> Dict[str, int | float]:
+    """Hit-rate metrics of the answer cache, empty when disabled"""
+    answer_cache: AnswerCaching = request.state.injector.get(AnswerCaching)
+    if answer_cache.cache is None:
+        return {}
+    return answer_cache.cache.stats()
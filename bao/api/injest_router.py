@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 from bao.api.authenticate import authenticated
 from bao.components.crawler.youtube_transcript.transcript_service import (
     TranscriptService,
@@ -23,7 +24,7 @@ class InjestResponse(BaseModel):
 
 
 @ingest_router.post("/youbute", tags=["Ingestion"])
-def ingest_youtube(
+async def ingest_youtube(
     request: Request, youtube_url: str, language: str = "en"
 ) -> InjestResponse:
     """Ingests from a Youtube URL.
@@ -31,13 +32,15 @@ def ingest_youtube(
     """
     crawler: TranscriptService = request.state.injector.get(TranscriptService)
     injestor: InjestService = request.state.injector.get(InjestService)
-    entry_file = crawler.extract_from_youtube(video_url=youtube_url, language=language)
+    entry_file = await run_in_threadpool(
+        crawler.extract_from_youtube, video_url=youtube_url, language=language
+    )
     if not entry_file:
         raise HTTPException(
             status_code=401,
             detail="Failed to extract transcripts/subtitles from the video",
         )
-    docs = injestor.injest_file(entry_file)
+    docs = await injestor.ainjest_file(entry_file)
     if not docs:
         return InjestResponse(data=[])
     return InjestResponse(
@@ -46,7 +49,7 @@ def ingest_youtube(
 
 
 @ingest_router.post("/yaml", tags=["Ingestion"])
-def ingest_yaml(request: Request, yaml_file: UploadFile) -> InjestResponse:
+async def ingest_yaml(request: Request, yaml_file: UploadFile) -> InjestResponse:
     """Ingests from a yaml file.
     Note, yaml format should be as follow:
     metadata:
@@ -59,7 +62,7 @@ def ingest_yaml(request: Request, yaml_file: UploadFile) -> InjestResponse:
     """
     injestor: InjestService = request.state.injector.get(InjestService)
 
-    docs = injestor.injest_bin(yaml_file.file, yaml_file.filename)  # type: ignore
+    docs = await injestor.ainjest_bin(yaml_file.file, yaml_file.filename)  # type: ignore
     if not docs:
         return InjestResponse(data=[])
     metadata = docs[0].metadata
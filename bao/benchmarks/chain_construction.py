@@ -0,0 +1,75 @@
+"""
+Per-request overhead of getting the chat pipelines: building them on every request,
+as the chat did before, against the pipelines compiled once by ChatChains.
+
+    python -m bao.benchmarks.chain_construction --requests 1000
+"""
+
+import argparse
+import time
+from typing import Callable, Dict
+
+from bao.benchmarks.utils import get_logger, percentile
+from bao.components.chains.chat_chain import ChatChains
+from bao.di import global_injector
+
+logger = get_logger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the per-request construction of the chat pipelines"
+)
+parser.add_argument(
+    "--requests",
+    type=int,
+    default=1000,
+    help="number of simulated requests per pipeline",
+    required=False,
+)
+
+
+def measure(get_chain: Callable[[], object], requests: int) -> Dict[str, float]:
+    latency = []
+    for _ in range(requests):
+        time_st = time.perf_counter()
+        get_chain()
+        latency.append(time.perf_counter() - time_st)
+    return {
+        "mean_us": sum(latency) / len(latency) * 1e6,
+        "p50_us": percentile(latency, 0.5) * 1e6,
+        "p95_us": percentile(latency, 0.95) * 1e6,
+    }
+
+
+def benchmark(requests: int) -> Dict[str, Dict[str, float]]:
+    chains = global_injector.get(ChatChains)
+    report = {}
+    for fallback in (False, True):
+        suffix = "fallback" if fallback else "primary"
+        report[f"chat_{suffix}_rebuilt"] = measure(
+            lambda: chains.build_chat_chain(fallback), requests
+        )
+        report[f"chat_{suffix}_compiled"] = measure(
+            lambda: chains.chat_chain(fallback), requests
+        )
+        # stream_chat: the retriever pipeline, then the answer chain
+        report[f"stream_{suffix}_rebuilt"] = measure(
+            lambda: (
+                chains.build_retriever_chain(fallback),
+                chains.answer.chain(fallback),
+            ),
+            requests,
+        )
+        report[f"stream_{suffix}_compiled"] = measure(
+            lambda: (chains.retriever_chain(fallback), chains.answer_chain(fallback)),
+            requests,
+        )
+    return report
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    for name, stats in benchmark(args.requests).items():
+        logger.info(
+            f"{name}: "
+            + ", ".join([f"{key}: {value:0.1f}" for key, value in stats.items()])
+        )
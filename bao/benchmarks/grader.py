@@ -0,0 +1,128 @@
+"""
+Compare the LLM grader and the local cross-encoder on a recorded query set:
+latency per question and agreement of the per-document verdicts.
+
+Record a query set from a text file of questions (one per line), with the documents
+the retriever returns for them:
+    python -m bao.benchmarks.grader --record questions.txt --queries data/grader_queries.jsonl
+Then run the benchmark:
+    python -m bao.benchmarks.grader --queries data/grader_queries.jsonl
+"""
+
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+from bao.benchmarks.utils import get_logger, percentile
+from bao.components.chains.grader_chain import Grader
+from bao.components.chains.retriever_chain import Retriever
+from bao.di import global_injector
+
+logger = get_logger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the cross-encoder grader against the LLM grader"
+)
+parser.add_argument(
+    "--queries",
+    type=str,
+    help="jsonl query set, one {question, documents, scores} per line",
+    required=True,
+)
+parser.add_argument(
+    "--record",
+    type=str,
+    default=None,
+    help="text file of questions. Retrieve their documents and write the query set instead of benchmarking",
+    required=False,
+)
+parser.add_argument(
+    "--fallback",
+    action="store_true",
+    help="use the fallback model of chain_templates.grader_model as the LLM grader, e.g. when the first one is cross-encoder",
+    required=False,
+)
+
+
+def record(questions_file: str, queries_file: str) -> None:
+    retriever = global_injector.get(Retriever)
+    questions = [
+        _.strip() for _ in Path(questions_file).read_text().splitlines() if _.strip()
+    ]
+    with open(queries_file, "w") as f:
+        for question in questions:
+            output = retriever.vector_search({"query_rewrite": {"query": question}})
+            item = {
+                "question": question,
+                "documents": [_.page_content for _ in output["vector_docs"]],
+                "scores": output["vector_scores"],
+            }
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    logger.info(f"{len(questions)} questions recorded into {queries_file}")
+
+
+def benchmark(queries_file: str, fallback: bool) -> Dict[str, Any]:
+    grader = global_injector.get(Grader)
+    llm_chain = grader.llm_chain(fallback)
+    threshold = grader.settings.grader.rerank_threshold
+    k = grader.settings.grader.k
+    items = [json.loads(_) for _ in Path(queries_file).read_text().splitlines() if _]
+    grader.reranker.score("warm up", ["warm up"])
+    llm_latency, ce_latency = [], []
+    agree = both_yes = llm_yes = ce_yes = n_docs = 0
+    top_k_overlap = []
+    for item in items:
+        question, documents = item["question"], item["documents"]
+        if not documents:
+            continue
+        time_st = time.time()
+        results = llm_chain.batch(
+            [{"question": question, "document": _} for _ in documents],
+            {"max_concurrency": len(documents)},
+        )
+        llm_latency.append(time.time() - time_st)
+        time_st = time.time()
+        relevance = grader.reranker.score(question, documents)
+        ce_latency.append(time.time() - time_st)
+
+        llm_verdicts = [_.get("score") == "yes" for _ in results]
+        ce_verdicts = [_ >= threshold for _ in relevance]
+        n_docs += len(documents)
+        agree += sum([a == b for a, b in zip(llm_verdicts, ce_verdicts)])
+        both_yes += sum([a and b for a, b in zip(llm_verdicts, ce_verdicts)])
+        llm_yes += sum(llm_verdicts)
+        ce_yes += sum(ce_verdicts)
+        # the documents each grader would hand to the answer chain
+        llm_top = set([i for i, _ in enumerate(llm_verdicts) if _][:k])
+        ce_ranked = sorted(range(len(documents)), key=lambda i: -relevance[i])
+        ce_top = set([i for i in ce_ranked if ce_verdicts[i]][:k])
+        if llm_top or ce_top:
+            top_k_overlap.append(len(llm_top & ce_top) / len(llm_top | ce_top))
+    return {
+        "questions": len(llm_latency),
+        "documents": n_docs,
+        "llm_latency_p50": percentile(llm_latency, 0.5),
+        "llm_latency_p95": percentile(llm_latency, 0.95),
+        "cross_encoder_latency_p50": percentile(ce_latency, 0.5),
+        "cross_encoder_latency_p95": percentile(ce_latency, 0.95),
+        "agreement": agree / n_docs if n_docs else 0.0,
+        "precision": both_yes / ce_yes if ce_yes else 0.0,
+        "recall": both_yes / llm_yes if llm_yes else 0.0,
+        "top_k_overlap": statistics.mean(top_k_overlap) if top_k_overlap else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.record:
+        record(args.record, args.queries)
+    else:
+        report = benchmark(args.queries, args.fallback)
+        for key, value in report.items():
+            if isinstance(value, float):
+                logger.info(f"{key}: {value:0.4f}")
+            else:
+                logger.info(f"{key}: {value}")
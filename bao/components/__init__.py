@@ -12,8 +12,12 @@ MODEL_TYPE = Literal[
     "llama3-70b-8192",  # Groq
 ]
 MODEL_TYPES = List[MODEL_TYPE]
+CROSS_ENCODER = "cross-encoder"  # local reranker in place of the LLM grader
+GRADER_MODEL_TYPE = Literal[MODEL_TYPE, "cross-encoder"]
+GRADER_MODEL_TYPES = List[GRADER_MODEL_TYPE]
 TOPIC_TYPE = Literal["greeting", "bao", "miles", "dc_farm", "federation", "other_forms"]
 METADATA_TYPE = Literal["str", "int"]
+EMBEDDING_BACKEND = Literal["torch-fp32", "torch-dynamic-int8", "onnxruntime"]
 CHAT_MODE_CHAT = "chat"
 CHAT_MODE_SEARCH = "search"
 CHAT_MODE = Literal["chat", "search"]
@@ -0,0 +1,114 @@
+import logging
+from typing import Any, Dict, Optional
+
+import numpy as np
+from injector import inject, singleton
+from langchain_core.runnables import RunnableLambda, RunnableSerializable
+
+from bao.components.chains.retriever_chain import Retriever
+from bao.components.injest import SOURCE_KEY
+from bao.settings.settings import Settings
+from bao.utils.answer_cache import AnswerCache
+
+logger = logging.getLogger(__name__)
+
+
+@singleton
+class AnswerCaching:
+    @inject
+    def __init__(self, settings: Settings, retriever: Retriever) -> None:
+        self.settings = settings
+        self.retriever = retriever
+        self.db = retriever.db
+        self.cache = None
+        if settings.answer_cache.enabled:
+            self.cache = AnswerCache(
+                max_entries=settings.answer_cache.max_entries,
+                ttl=settings.answer_cache.ttl,
+            )
+
+    def _sync(self) -> None:
+        app_name = self.settings.retriever.collection_name
+        head = self.db.event_sync.head(app_name)
+        if self.cache.log_id is None:  # type: ignore
+            self.cache.log_id = head  # type: ignore
+            return
+        if head <= self.cache.log_id:  # type: ignore
+            return
+        # the injest log tells the sources re-ingested or removed since
+        records = self.db.event_sync.log_since(app_name, self.cache.log_id)  # type: ignore
+        self.cache.sync(records, SOURCE_KEY)  # type: ignore
+
+    def _key(self, input: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The query vector and filter key of the question, None when its answer is not cacheable"""
+        if "greeting" == (input.get("topic") or {}).get("type"):
+            return None
+        query, k, filter = self.retriever.search_params(input)
+        if not query:
+            return None
+        vector = np.asarray(self.db.embeddings.embed_query(query))  # type: ignore
+        if input.get("chat_history"):
+            # the answer chain sees the history too, only cache standalone questions
+            question = np.asarray(
+                self.db.embeddings.embed_query(input.get("question") or "")  # type: ignore
+            )
+            similarity = float(
+                np.dot(vector, question)
+                / (np.linalg.norm(vector) * np.linalg.norm(question) or 1)
+            )
+            if similarity < self.settings.answer_cache.history_min_similarity:
+                logger.info(
+                    f"answer cache skipped, relevant history: {similarity:0.4f}"
+                )
+                return None
+        return {"vector": vector, "filter_key": AnswerCache.filter_key(filter, k)}
+
+    def lookup(self, input: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The cache key of the question with the log id it was looked up at, and the cached answer if any"""
+        if self.cache is None:
+            return None
+        self._sync()
+        key = self._key(input)
+        if key is None:
+            return None
+        key["log_id"] = self.cache.log_id
+        key["answer"] = None
+        found = self.cache.get(
+            key["vector"], key["filter_key"], self.settings.answer_cache.min_similarity
+        )
+        if found is not None:
+            similarity, key["answer"] = found
+            logger.info(f"answer cache hit, similarity: {similarity:0.4f}")
+        logger.info(f"answer cache stats: {self.cache.stats()}")
+        return key
+
+    def store(self, output: Dict[str, Any]) -> Dict[str, Any]:
+        """Cache the answer of the output of the chat pipeline, looked up by `lookup` before"""
+        key = output.get("answer_cache")
+        docs = output.get("input_documents", [])
+        if self.cache is None or key is None or not docs:
+            return output
+        if not (output.get("output_text") or "").strip():
+            return output
+        self.cache.put(
+            key["vector"],
+            key["filter_key"],
+            {"output_text": output["output_text"], "input_documents": docs},
+            [_.metadata.get(SOURCE_KEY) for _ in docs if _.metadata.get(SOURCE_KEY)],
+            key["log_id"],
+        )
+        return output
+
+    @staticmethod
+    def hit(input: Dict[str, Any]) -> bool:
+        return (input.get("answer_cache") or {}).get("answer") is not None
+
+    @staticmethod
+    def cached_output(input: Dict[str, Any]) -> Dict[str, Any]:
+        return {**input, **input["answer_cache"]["answer"], "answer_cache_hit": True}
+
+    def lookup_chain(self) -> RunnableSerializable[Dict[str, Any], Any]:
+        return RunnableLambda(self.lookup)
+
+    def store_chain(self) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return RunnableLambda(self.store)
@@ -1,12 +1,14 @@
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 from injector import inject, singleton
 from langchain_core.runnables import (
+    Runnable,
     RunnableBranch,
     RunnablePassthrough,
     RunnableSerializable,
 )
 
+from bao.components.chains.answer_cache_chain import AnswerCaching
 from bao.components.chains.grader_chain import Grader
 from bao.components.chains.intent_classification_chain import IntentClassification
 from bao.components.chains.query_answer_chain import Answering
@@ -14,6 +16,7 @@ from bao.components.chains.query_rewrite_chain import QueryReWrite
 from bao.components.chains.retriever_chain import Retriever
 from bao.components.chains.greeting_chain import Greeting
 from bao.settings.settings import Settings
+from bao.utils.query_filters import parse_query_filters
 
 
 @singleton
@@ -28,6 +31,7 @@ class ChatChains:
         retriever: Retriever,
         grader: Grader,
         answer: Answering,
+        answer_cache: AnswerCaching,
     ) -> None:
         self.settings = settings
         self.intent_classifier = intent_classifier
@@ -36,18 +40,52 @@ class ChatChains:
         self.retriever = retriever
         self.grader = grader
         self.answer = answer
+        self.answer_cache = answer_cache
+        # the pipelines are stateless, compile them once instead of on every request
+        self.pipelines: Dict[
+            Tuple[str, bool], RunnableSerializable[Dict[str, Any], Dict[str, Any]]
+        ] = {}
+        for fallback in (False, True):
+            self.pipelines[("chat", fallback)] = self.build_chat_chain(fallback)
+            self.pipelines[("retriever", fallback)] = self.build_retriever_chain(
+                fallback
+            )
+            self.pipelines[("search", fallback)] = self.build_search_chain(fallback)
+            self.pipelines[("answer", fallback)] = self.answer.chain(fallback)
 
-    def retriever_chains(self, fallback: bool = False):
-        return (
-            RunnablePassthrough.assign(query_rewrite=self.query_rewrite.chain(fallback))
-            | self.retriever.chain()
-            | self.grader.chain(fallback)
+    def classify_and_rewrite(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        """
+        Intent classification and query rewrite run concurrently,
+        with the speculative search on the raw question when enabled.
+        The speculative result is dropped by the greeting branch.
+        A greeting classified locally skips all of them.
+        """
+        steps: Dict[str, Any] = {
+            "topic": self.intent_classifier.chain(fallback),
+            "query_rewrite": self.query_rewrite.chain(fallback),
+        }
+        if self.settings.retriever.speculative_search:
+            steps["speculative"] = self.retriever.speculative_chain()
+        if not self.settings.intent.enabled:
+            return RunnablePassthrough.assign(**steps)
+        return RunnablePassthrough.assign(
+            local_topic=self.intent_classifier.local_chain()
+        ) | RunnableBranch(
+            (
+                lambda x: "greeting" == (x["local_topic"] or {}).get("type"),
+                RunnablePassthrough.assign(topic=lambda x: x["local_topic"]),
+            ),
+            RunnablePassthrough.assign(**steps),
         )
 
+    def retriever_chains(self, fallback: bool = False):
+        return self.retriever.chain() | self.grader.chain(fallback)
+
     def retriever_chat_chains(self, fallback: bool = False):
         return (
-            RunnablePassthrough.assign(query_rewrite=self.query_rewrite.chain(fallback))
-            | self.retriever.chain()
+            self.retriever.chain()
             | self.grader.chain(fallback)
             | self.answer.chain(fallback)
         )
@@ -58,21 +96,99 @@ class ChatChains:
             {"output_text": self.greeting.chain(fallback)},
         )
 
-    def chat_chain(
+    def with_answer_cache(
+        self, fallback: bool, chains: Runnable, store: bool
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        """
+        Look up the answer cache after the query rewrite, a hit skips the chains.
+        The answer is cached after the chains when `store`, stream_chat caches the streamed one itself.
+        """
+        if not self.settings.answer_cache.enabled:
+            return self.classify_and_rewrite(fallback) | RunnableBranch(
+                self.greeting_branch(fallback), chains
+            )
+        if store:
+            chains = chains | self.answer_cache.store_chain()
+        return (
+            self.classify_and_rewrite(fallback)
+            | RunnablePassthrough.assign(answer_cache=self.answer_cache.lookup_chain())
+            | RunnableBranch(
+                self.greeting_branch(fallback),
+                (self.answer_cache.hit, self.answer_cache.cached_output),
+                chains,
+            )
+        )
+
+    def build_chat_chain(
         self, fallback: bool = False
     ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
-        return RunnablePassthrough.assign(
-            topic=self.intent_classifier.chain(fallback),
-        ) | RunnableBranch(
-            self.greeting_branch(fallback),
-            self.retriever_chat_chains(fallback),
+        return self.with_answer_cache(
+            fallback, self.retriever_chat_chains(fallback), store=True
         )
 
-    def retriever_chain(
+    def build_retriever_chain(
         self, fallback: bool = False
     ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
-        return RunnablePassthrough.assign(
-            topic=self.intent_classifier.chain(fallback),
-        ) | RunnableBranch(
-            self.greeting_branch(fallback), self.retriever_chains(fallback)
+        return self.with_answer_cache(
+            fallback, self.retriever_chains(fallback), store=False
         )
+
+    def search_filters(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        query_rewrite, topic = parse_query_filters(
+            input.get("question") or "",
+            self.settings.search_mode.topic_keywords,
+            self.settings.crawler.youtube_url_domain,
+            self.settings.crawler.youtube_short_url_domain,
+        )
+        return {
+            "query_rewrite": query_rewrite,
+            "topic": {"type": topic} if topic else {},
+        }
+
+    def build_search_chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        """
+        Search mode: the filters parsed locally and the results ranked by vector score.
+        The LLM stages are opt-in by search_mode settings.
+        """
+        config = self.settings.search_mode
+        steps: Dict[str, Any] = {
+            "query_rewrite": lambda x: x["search_filters"]["query_rewrite"],
+            "topic": lambda x: x["search_filters"]["topic"],
+        }
+        if config.query_rewrite:
+            steps["query_rewrite"] = self.query_rewrite.chain(fallback)
+        if config.intent_classification:
+            steps["topic"] = self.intent_classifier.chain(fallback)
+        search = self.retriever.chain() | (
+            self.grader.chain(fallback)
+            if config.grader
+            else RunnablePassthrough.assign(input_documents=lambda x: x["vector_docs"])
+        )
+        chain = RunnablePassthrough.assign(
+            search_filters=self.search_filters
+        ) | RunnablePassthrough.assign(**steps)
+        if config.intent_classification:
+            return chain | RunnableBranch(self.greeting_branch(fallback), search)
+        return chain | search
+
+    def chat_chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return self.pipelines[("chat", fallback)]
+
+    def retriever_chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return self.pipelines[("retriever", fallback)]
+
+    def search_chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return self.pipelines[("search", fallback)]
+
+    def answer_chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return self.pipelines[("answer", fallback)]
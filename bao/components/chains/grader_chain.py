@@ -1,14 +1,41 @@
-from typing import Any, Dict
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
 
 from injector import inject, singleton
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableSerializable
 
+from bao.components import CROSS_ENCODER
+from bao.components.injest import SOURCE_KEY
 from bao.components.llms import LLMs
 from bao.settings.settings import Settings
+from bao.utils.cross_encoder import CrossEncoderReranker
+from bao.utils.grader_verdict_cache import GraderVerdictCache
+from bao.utils.query_vector_cache import normalize_query
+from bao.utils.strings import estimate_tokens, hash_of_text, truncate_tokens
 from langchain_core.output_parsers.json import JsonOutputParser
 from langchain.chains.transform import TransformChain
 
+logger = logging.getLogger(__name__)
+
+ACCEPT, REJECT = "accept", "reject"
+
+LISTWISE_TEMPLATE = """You are a grader evaluating whether each of the numbered documents helps to answer the question.
+Return a JSON object with the key "documents": a list with one object per document, with the document number as "id" and "yes" or "no" as "score". For example:
+{{"documents": [{{"id": 0, "score": "yes"}}, {{"id": 1, "score": "no"}}]}}
+Grade every document. Do not return anything else."""
+
+LISTWISE_HUMAN = """Question:
+{question}
+
+Documents:
+{documents}"""
+
 
 @singleton
 class Grader:
@@ -16,10 +43,324 @@ class Grader:
     def __init__(self, settings: Settings, llms: LLMs) -> None:
         self.settings = settings
         self.llms = llms
+        # totals of the grader_stats of all the requests
+        self.stats: Counter = Counter()
+        self.lock = threading.Lock()
+        self._reranker = None
+        self._reranker_lock = threading.Lock()
+        self.verdict_cache = None
+        if settings.grader.verdict_cache_path:
+            self.verdict_cache = GraderVerdictCache(
+                db_root=settings.grader.verdict_cache_path,
+                ttl=settings.grader.verdict_cache_ttl,
+            )
 
-    def chain(
-        self, fallback: bool = False
-    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+    @property
+    def reranker(self) -> CrossEncoderReranker:
+        """The cross-encoder is loaded on first use"""
+        with self._reranker_lock:
+            if self._reranker is None:
+                local = self.settings.local
+                self._reranker = CrossEncoderReranker(
+                    model_id=local.reranker_hf_model_name,  # type: ignore
+                    max_tokens=local.reranker_hf_model_tokens,
+                    batch_size=self.settings.grader.rerank_batch_size,
+                )
+            return self._reranker
+
+    def _band(self, score: Optional[float]) -> Optional[str]:
+        """Verdict given by the vector score alone, None when the LLM has to grade"""
+        grader = self.settings.grader
+        if score is None:
+            return None
+        if grader.auto_accept_score is not None and score >= grader.auto_accept_score:
+            return ACCEPT
+        if grader.auto_reject_score is not None and score < grader.auto_reject_score:
+            return REJECT
+        return None
+
+    def _triage(
+        self, docs: List[Document], scores: List[float]
+    ) -> Tuple[List[Optional[str]], Dict[str, int]]:
+        """
+        Verdicts by the score bands, in the order of the docs.
+        The documents left undecided are graded by the LLM, unless enough documents are
+        accepted already by scores above all of them.
+        """
+        scores = scores if len(scores) == len(docs) else [None] * len(docs)  # type: ignore
+        verdicts = [self._band(_) for _ in scores]
+        n_accepted = 0
+        overflow = 0
+        for i, verdict in enumerate(verdicts):
+            if verdict == ACCEPT:
+                n_accepted += 1
+            elif verdict is None and n_accepted >= (self.settings.grader.k or len(docs)):
+                # dropped for the k accepted before, not for its score
+                verdicts[i] = REJECT
+                overflow += 1
+        stats = {
+            "auto_accepted": verdicts.count(ACCEPT),
+            "auto_rejected": verdicts.count(REJECT) - overflow,
+            "overflow": overflow,
+            "llm_graded": verdicts.count(None),
+        }
+        stats["llm_calls_saved"] = len(docs) - stats["llm_graded"]
+        return verdicts, stats
+
+    def _settled(self, verdicts: List[Optional[str]]) -> bool:
+        """The k best scored relevant documents are known: the first k accepted come before any undecided one"""
+        k = self.settings.grader.k
+        n_accepted = 0
+        for verdict in verdicts:
+            if verdict is None:
+                return False
+            if verdict == ACCEPT:
+                n_accepted += 1
+                if k and n_accepted >= k:
+                    return True
+        return True
+
+    @staticmethod
+    def _verdict(result: Dict[str, Any]) -> str:
+        return ACCEPT if result["score"] == "yes" else REJECT
+
+    def _grade(
+        self,
+        chain: RunnableSerializable,
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+    ) -> int:
+        """Grade the documents q_docs {index: chain input}. Returns the number of cancelled calls."""
+        if not self.settings.grader.early_exit:
+            results = chain.batch(
+                list(q_docs.values()), {"max_concurrency": len(q_docs)}
+            )
+            for i, res in zip(q_docs, results):
+                verdicts[i] = self._verdict(res)
+            return 0
+        executor = ThreadPoolExecutor(max_workers=len(q_docs))
+        futures = {
+            executor.submit(chain.invoke, q_doc): i for i, q_doc in q_docs.items()
+        }
+        try:
+            for future in as_completed(futures):
+                verdicts[futures[future]] = self._verdict(future.result())
+                if self._settled(verdicts):
+                    break
+        finally:
+            # calls in flight are abandoned, their results are not waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+        return len([_ for _ in futures if not _.done()])
+
+    async def _agrade(
+        self,
+        chain: RunnableSerializable,
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+    ) -> int:
+        tasks = {
+            asyncio.create_task(chain.ainvoke(q_doc)): i for i, q_doc in q_docs.items()
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    verdicts[tasks[task]] = self._verdict(task.result())
+                if self.settings.grader.early_exit and self._settled(verdicts):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return len(pending)
+
+    def _listwise_groups(
+        self, question: str, q_docs: Dict[int, Dict[str, Any]]
+    ) -> List[List[Tuple[int, str]]]:
+        """Truncated (index, document) groups, each fitting the token budget of one listwise call"""
+        grader = self.settings.grader
+        template = self.settings.chain_templates.grader_listwise_template
+        budget = grader.listwise_max_tokens - estimate_tokens(
+            (template or LISTWISE_TEMPLATE) + LISTWISE_HUMAN + question
+        )
+        groups: List[List[Tuple[int, str]]] = []
+        group: List[Tuple[int, str]] = []
+        used = 0
+        for i, q_doc in q_docs.items():
+            text = truncate_tokens(q_doc["document"], grader.listwise_doc_max_tokens)
+            cost = estimate_tokens(text) + 8  # numbering and separators
+            if group and used + cost > budget:
+                groups.append(group)
+                group, used = [], 0
+            group.append((i, text))
+            used += cost
+        if group:
+            groups.append(group)
+        return groups
+
+    @staticmethod
+    def _listwise_input(question: str, group: List[Tuple[int, str]]) -> Dict[str, Any]:
+        return {
+            "question": question,
+            "documents": "\n\n".join(
+                [f"[{n}] {text}" for n, (_, text) in enumerate(group)]
+            ),
+        }
+
+    def _parse_listwise(
+        self, result: Any, group: List[Tuple[int, str]]
+    ) -> Dict[int, str]:
+        """Verdicts {document index: verdict} of a listwise answer, malformed items are left out"""
+        if isinstance(result, Exception):
+            logger.warning(f"listwise grading failed: {result}")
+            return {}
+        items = result.get("documents") if isinstance(result, dict) else result
+        if not isinstance(items, list):
+            return {}
+        verdicts = {}
+        for item in items:
+            if not isinstance(item, dict) or item.get("score") not in ("yes", "no"):
+                continue
+            try:
+                n = int(item.get("id"))  # type: ignore
+            except (TypeError, ValueError):
+                continue
+            if 0 <= n < len(group):
+                verdicts[group[n][0]] = ACCEPT if item["score"] == "yes" else REJECT
+        return verdicts
+
+    def _apply_listwise(
+        self,
+        groups: List[List[Tuple[int, str]]],
+        results: List[Any],
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+        stats: Dict[str, int],
+    ) -> Dict[int, Dict[str, Any]]:
+        """Set the listwise verdicts. Returns the documents left for pointwise grading."""
+        for group, result in zip(groups, results):
+            for i, verdict in self._parse_listwise(result, group).items():
+                verdicts[i] = verdict
+        left = {i: q_doc for i, q_doc in q_docs.items() if verdicts[i] is None}
+        stats["listwise_calls"] = len(groups)
+        stats["listwise_fallbacks"] = len(left)
+        if left:
+            logger.warning(
+                f"{len(left)} documents not graded by the listwise call, grade them one by one"
+            )
+        return left
+
+    def _grade_listwise(
+        self,
+        chain: RunnableSerializable,
+        question: str,
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+        stats: Dict[str, int],
+    ) -> Dict[int, Dict[str, Any]]:
+        groups = self._listwise_groups(question, q_docs)
+        results = chain.batch(
+            [self._listwise_input(question, _) for _ in groups],
+            {"max_concurrency": len(groups)},
+            return_exceptions=True,
+        )
+        return self._apply_listwise(groups, results, q_docs, verdicts, stats)
+
+    async def _agrade_listwise(
+        self,
+        chain: RunnableSerializable,
+        question: str,
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+        stats: Dict[str, int],
+    ) -> Dict[int, Dict[str, Any]]:
+        groups = self._listwise_groups(question, q_docs)
+        results = await chain.abatch(
+            [self._listwise_input(question, _) for _ in groups],
+            {"max_concurrency": len(groups)},
+            return_exceptions=True,
+        )
+        return self._apply_listwise(groups, results, q_docs, verdicts, stats)
+
+    def _cached_verdicts(
+        self,
+        keys: Dict[int, str],
+        q_docs: Dict[int, Dict[str, Any]],
+        verdicts: List[Optional[str]],
+        stats: Dict[str, int],
+    ) -> Dict[int, Dict[str, Any]]:
+        """Set the cached verdicts. Returns the documents left for the LLM grader."""
+        if self.verdict_cache is None or not q_docs:
+            return q_docs
+        found = self.verdict_cache.get_many(keys.values())
+        for i, key in keys.items():
+            if key in found:
+                verdicts[i] = found[key]
+        stats["cache_hits"] = len([_ for _ in keys.values() if _ in found])
+        stats["llm_graded"] -= stats["cache_hits"]
+        stats["llm_calls_saved"] += stats["cache_hits"]
+        return {i: q_doc for i, q_doc in q_docs.items() if verdicts[i] is None}
+
+    def _cache_verdicts(
+        self,
+        keys: Dict[int, str],
+        docs: List[Document],
+        verdicts: List[Optional[str]],
+    ) -> None:
+        if self.verdict_cache is None:
+            return
+        self.verdict_cache.put_many(
+            [
+                (key, docs[i].metadata.get(SOURCE_KEY, ""), verdicts[i])  # type: ignore
+                for i, key in keys.items()
+                if verdicts[i] is not None
+            ]
+        )
+
+    def _record(self, stats: Dict[str, int]) -> None:
+        logger.info(f"grader stats: {stats}")
+        with self.lock:
+            self.stats.update(stats)
+
+    def rerank(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Grade with the local cross-encoder: the documents not rejected by their vector score
+        are ordered by relevance, the top k above grader.rerank_threshold are kept.
+        """
+        docs = input.get("vector_docs", [])
+        if not docs:
+            return {"input_documents": [], "grader_stats": {}}
+        scores = input.get("vector_scores", [])
+        scores = scores if len(scores) == len(docs) else [None] * len(docs)
+        candidates = [i for i, _ in enumerate(scores) if self._band(_) != REJECT]
+        relevance = self.reranker.score(
+            input.get("question", ""), [docs[i].page_content for i in candidates]
+        )
+        ranked = sorted(zip(candidates, relevance), key=lambda _: _[1], reverse=True)
+        stats = {
+            "auto_rejected": len(docs) - len(candidates),
+            "reranked": len(candidates),
+            "llm_calls_saved": len(docs),
+        }
+        self._record(stats)
+        return {
+            "input_documents": [
+                docs[i]
+                for i, score in ranked
+                if score >= self.settings.grader.rerank_threshold
+            ][: self.settings.grader.k],
+            "grader_stats": stats,
+        }
+
+    async def arerank(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.rerank, input
+        )
+
+    def llm_chain(self, fallback: bool = False) -> RunnableSerializable:
+        """Pointwise LLM grader: {question, document} -> {"score": "yes" or "no"}"""
         llm = self.llms.get_llm(
             llm_type=self.settings.chain_templates.grader_model[1 if fallback else 0]
         )
@@ -36,26 +377,121 @@ class Grader:
                 ),
             ]
         )
+        return chat_template | llm | JsonOutputParser()
 
-        def grader(input: Dict[str, Any]) -> Dict[str, Any]:
-            question = input.get("question")
-            docs = input.get("vector_docs", [])
-            if not docs:
-                return {"input_documents": []}
-            q_docs = [{"question": question, "document": _.page_content} for _ in docs]
-            chain = chat_template | llm | JsonOutputParser()
-            results = chain.batch(q_docs, {"max_concurrency": len(q_docs)})
-            doc_idx_relevant = [
-                i for i, res in enumerate(results) if res["score"] == "yes"
+    def listwise_chain(self, fallback: bool = False) -> RunnableSerializable:
+        """Listwise LLM grader: {question, documents} -> {"documents": [{"id", "score"}]}"""
+        llm = self.llms.get_llm(
+            llm_type=self.settings.chain_templates.grader_model[1 if fallback else 0]
+        )
+        chat_template = ChatPromptTemplate.from_messages(
+            [
+                (
+                    "system",
+                    self.settings.chain_templates.grader_listwise_template
+                    or LISTWISE_TEMPLATE,
+                ),
+                ("human", LISTWISE_HUMAN),
             ]
+        )
+        return chat_template | llm | JsonOutputParser()
+
+    def chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        grader_model = self.settings.chain_templates.grader_model[1 if fallback else 0]
+        if grader_model == CROSS_ENCODER:
+            return TransformChain(
+                transform=self.rerank,
+                atransform=self.arerank,
+                input_variables=["question", "vector_docs"],
+                output_variables=["input_documents", "grader_stats"],
+            )  # type: ignore
+        chain = self.llm_chain(fallback)
+        listwise = None
+        template = self.settings.chain_templates.grader_template
+        if self.settings.grader.mode == "listwise":
+            listwise = self.listwise_chain(fallback)
+            template += (
+                self.settings.chain_templates.grader_listwise_template
+                or LISTWISE_TEMPLATE
+            )
+        # verdicts are cached per grader model and prompt
+        template_hash = hash_of_text(template)
+
+        def prepare(input: Dict[str, Any]) -> Tuple[
+            List[Document],
+            List[Optional[str]],
+            Dict[str, int],
+            Dict[int, Dict[str, Any]],
+            Dict[int, str],
+        ]:
+            docs = input.get("vector_docs", [])
+            verdicts, stats = self._triage(docs, input.get("vector_scores", []))
+            q_docs = {
+                i: {"question": input.get("question"), "document": docs[i].page_content}
+                for i, verdict in enumerate(verdicts)
+                if verdict is None
+            }
+            question = normalize_query(input.get("question") or "")
+            keys = {
+                i: GraderVerdictCache.key(
+                    question, docs[i].page_content, grader_model, template_hash
+                )
+                for i in q_docs
+            }
+            q_docs = self._cached_verdicts(keys, q_docs, verdicts, stats)
+            keys = {i: keys[i] for i in q_docs}
+            return docs, verdicts, stats, q_docs, keys
+
+        def output(
+            docs: List[Document],
+            verdicts: List[Optional[str]],
+            stats: Dict[str, int],
+            keys: Dict[int, str],
+        ) -> Dict[str, Any]:
+            self._cache_verdicts(keys, docs, verdicts)
+            self._record(stats)
             return {
-                "input_documents": [docs[_] for _ in doc_idx_relevant][
-                    : self.settings.grader.k
-                ]
+                "input_documents": [
+                    doc for doc, verdict in zip(docs, verdicts) if verdict == ACCEPT
+                ][: self.settings.grader.k],
+                "grader_stats": stats,
             }
 
+        def grader(input: Dict[str, Any]) -> Dict[str, Any]:
+            if not input.get("vector_docs"):
+                return {"input_documents": [], "grader_stats": {}}
+            docs, verdicts, stats, q_docs, keys = prepare(input)
+            if q_docs and listwise is not None:
+                q_docs = self._grade_listwise(
+                    listwise, input.get("question", ""), q_docs, verdicts, stats
+                )
+            if q_docs:
+                stats["llm_cancelled"] = self._grade(chain, q_docs, verdicts)
+            return output(docs, verdicts, stats, keys)
+
+        async def agrader(input: Dict[str, Any]) -> Dict[str, Any]:
+            if not input.get("vector_docs"):
+                return {"input_documents": [], "grader_stats": {}}
+            # the verdict cache is sqlite, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            docs, verdicts, stats, q_docs, keys = await loop.run_in_executor(
+                None, prepare, input
+            )
+            if q_docs and listwise is not None:
+                q_docs = await self._agrade_listwise(
+                    listwise, input.get("question", ""), q_docs, verdicts, stats
+                )
+            if q_docs:
+                stats["llm_cancelled"] = await self._agrade(chain, q_docs, verdicts)
+            return await loop.run_in_executor(
+                None, output, docs, verdicts, stats, keys
+            )
+
         return TransformChain(
             transform=grader,
+            atransform=agrader,
             input_variables=["question", "vector_docs"],
-            output_variables=["input_documents"],
+            output_variables=["input_documents", "grader_stats"],
         )  # type: ignore
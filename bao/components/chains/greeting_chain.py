@@ -1,9 +1,10 @@
+import random
 from typing import Any, Dict
 
 from injector import inject, singleton
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnableSerializable
+from langchain_core.runnables import RunnableLambda, RunnableSerializable
 
 from bao.components.llms import LLMs
 from bao.settings.settings import Settings
@@ -17,6 +18,9 @@ class Greeting:
         self.llms = llms
 
     def chain(self, fallback:bool=False) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        if self.settings.intent.greeting_replies:
+            # canned replies, no LLM call
+            return RunnableLambda(lambda x: random.choice(self.settings.intent.greeting_replies))  # type: ignore
         llm = self.llms.get_llm(llm_type=self.settings.chain_templates.greeting_model[1 if fallback else 0])
         chat_template = ChatPromptTemplate.from_messages(
             [
@@ -1,22 +1,159 @@
-from typing import Any, Dict
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, get_args
 
+import numpy as np
 from injector import inject, singleton
 from langchain_core.output_parsers.json import JsonOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableSerializable
+from langchain_core.runnables import (
+    RunnableBranch,
+    RunnableLambda,
+    RunnableSerializable,
+)
 
+from bao.components import TOPIC_TYPE
 from bao.components.llms import LLMs
+from bao.components.vectordb import QdrantVectorDB
 from bao.settings.settings import Settings
 
+logger = logging.getLogger(__name__)
+
+GREETING = "greeting"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
 
 @singleton
 class IntentClassification:
     @inject
-    def __init__(self, settings: Settings, llms: LLMs) -> None:
+    def __init__(self, settings: Settings, llms: LLMs, db: QdrantVectorDB) -> None:
         self.settings = settings
         self.llms = llms
+        self.db = db
+        self.lock = threading.Lock()
+        # greeting exemplar vectors, topic names and their centroids, swapped as a whole
+        self._snapshot: Optional[Tuple[np.ndarray, List[str], np.ndarray]] = None
+        self._log_id: Optional[int] = None
+        self._built_at = 0.0
+        # the prototypes are built off the request path
+        self._building: Optional[Future] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        if settings.intent.enabled:
+            self._build_in_background()
 
-    def chain(
+    def _build_prototypes(self) -> None:
+        config = self.settings.intent
+        # read before building, an ingestion meanwhile triggers another build
+        log_id = self.db.event_sync.head(self.settings.retriever.collection_name)
+        greetings = [
+            self.db.embeddings.embed_query(_) for _ in config.greeting_exemplars  # type: ignore
+        ]
+        topics, centroids = [], []
+        for topic in get_args(TOPIC_TYPE):
+            if topic == GREETING:
+                continue
+            vectors = self.db.topic_vectors(topic, config.max_topic_points)
+            if vectors:
+                topics.append(topic)
+                centroids.append(np.mean(_normalize(np.array(vectors)), axis=0))
+        self._snapshot = (
+            _normalize(np.array(greetings, dtype=np.float32)),
+            topics,
+            _normalize(np.array(centroids, dtype=np.float32)),
+        )
+        self._log_id = log_id
+        self._built_at = time.time()
+        logger.info(f"intent prototypes built, topics: {topics}")
+
+    def _build(self) -> None:
+        try:
+            self._build_prototypes()
+        except Exception:
+            logger.exception("failed to build the intent prototypes")
+
+    def _build_in_background(self) -> None:
+        with self.lock:
+            if self._building is None or self._building.done():
+                self._building = self._executor.submit(self._build)
+
+    def _prototypes(self) -> Optional[Tuple[np.ndarray, List[str], np.ndarray]]:
+        """
+        The last built prototypes, None until the first build is done.
+        They are rebuilt in the background when new chunks were ingested since, at most once per refresh_interval.
+        """
+        # the topic centroids are rebuilt when the injest log moved
+        log_id = self.db.event_sync.head(self.settings.retriever.collection_name)
+        if self._snapshot is None or (
+            log_id != self._log_id
+            and time.time() - self._built_at > self.settings.intent.refresh_interval
+        ):
+            self._build_in_background()
+        return self._snapshot
+
+    def classify(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        Local intent classification of the question, None when uncertain.
+        Greeting is scored by the nearest exemplar, the topics by their centroid.
+        """
+        config = self.settings.intent
+        prototypes = self._prototypes()
+        if prototypes is None:
+            return None
+        greetings, topics, centroids = prototypes
+        vector = _normalize(
+            np.asarray(self.db.embeddings.embed_query(question), dtype=np.float32)  # type: ignore
+        )
+        scores = []
+        if len(greetings):
+            scores.append((GREETING, float(np.max(greetings @ vector))))
+        if len(topics):
+            scores.extend(zip(topics, (centroids @ vector).tolist()))
+        if not scores:
+            return None
+        scores.sort(key=lambda _: -_[1])
+        intent, score = scores[0]
+        margin = score - scores[1][1] if len(scores) > 1 else score
+        min_similarity = (
+            config.greeting_min_similarity
+            if intent == GREETING
+            else config.topic_min_similarity
+        )
+        if score < min_similarity or margin < config.min_margin:
+            logger.info(
+                f"uncertain local intent: {intent}, score: {score:0.4f}, margin: {margin:0.4f}"
+            )
+            return None
+        logger.info(f"local intent: {intent}, score: {score:0.4f}")
+        return {"type": intent, "confidence": round(score, 4)}
+
+    def local_chain(self) -> RunnableSerializable[Dict[str, Any], Any]:
+        """{question} -> the local classification, None when uncertain or disabled"""
+
+        def classify(input: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            if not self.settings.intent.enabled:
+                return None
+            try:
+                return self.classify(input.get("question") or "")
+            except Exception:
+                logger.exception("failed to classify the intent locally")
+                return None
+
+        async def aclassify(input: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, classify, input
+            )
+
+        return RunnableLambda(classify, afunc=aclassify)
+
+    def llm_chain(
         self, fallback: bool = False
     ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
         llm = self.llms.get_llm(
@@ -31,3 +168,15 @@ class IntentClassification:
             ]
         )
         return chat_template | llm | JsonOutputParser()
+
+    def chain(
+        self, fallback: bool = False
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        """The local classification in `local_topic` if any, else the LLM classification"""
+        return RunnableBranch(
+            (
+                lambda x: x.get("local_topic") is not None,
+                lambda x: x["local_topic"],
+            ),
+            self.llm_chain(fallback),
+        )  # type: ignore
@@ -1,15 +1,19 @@
 import time
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 from injector import inject, singleton
 from langchain.chains import TransformChain
-from langchain_core.runnables import RunnableSerializable
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda, RunnableSerializable
 
 from bao.components import CHAT_MODE_SEARCH, SCALE_CONTEXT_RETREIVER
 from bao.components.vectordb import QdrantVectorDB
 from bao.settings.settings import Settings
 from bao.settings.settings import MetadataValue
+from bao.utils.query_vector_cache import normalize_query
+from bao.utils.retrieval_cache import Hits, RetrievalCache
 
 logger = logging.getLogger(__name__)
 
@@ -20,52 +24,233 @@ class Retriever:
     def __init__(self, settings: Settings, db: QdrantVectorDB):
         self.settings = settings
         self.db = db
+        self.result_cache = None
+        if settings.retriever.result_cache_max_entries > 0:
+            self.result_cache = RetrievalCache(
+                max_entries=settings.retriever.result_cache_max_entries,
+                ttl=settings.retriever.result_cache_ttl,
+            )
 
-    def chain(self) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
-        def vector_search(input: Dict[str, Any]) -> Dict[str, Any]:
-            time_st = time.time()
-            retriever_input = input.get("query_rewrite", {})
-            retriever_input["topic"] = input.get("topic", {}).get("type")
-            chat_mode = input.get("chat_mode")
-            k = self.settings.retriever.k
-            context_size = input.get("context_size", k)
-            if chat_mode == CHAT_MODE_SEARCH:
-                k = int(context_size * SCALE_CONTEXT_RETREIVER)
-            filter_model = MetadataValue(**retriever_input).to_dict(
-                exclude_defaults=True
+    def _cached_hits(
+        self, query: str, k: int, filter: Optional[Dict[str, Any]]
+    ) -> Tuple[Optional[str], int, Optional[Hits]]:
+        """Returns the cache key, the current generation and the cached hits if any"""
+        if self.result_cache is None:
+            return None, 0, None
+        key = self.result_cache.key(
+            query, filter, k, self.settings.retriever.score_threshold
+        )
+        # read before searching, a concurrent ingestion then invalidates the stored entry
+        # the injest log id is the generation of the collection
+        generation = self.db.event_sync.head(self.settings.retriever.collection_name)
+        return key, generation, self.result_cache.get(key, generation)
+
+    def _cache_hits(
+        self,
+        key: Optional[str],
+        generation: int,
+        docs_and_similarities: List[Tuple[Document, float]],
+    ) -> None:
+        if self.result_cache is None or key is None:
+            return
+        self.result_cache.put(
+            key,
+            generation,
+            [
+                (str(doc.metadata["_id"]), doc.metadata["_collection_name"], score)
+                for doc, score in docs_and_similarities
+            ],
+        )
+
+    def search_params(
+        self, input: Dict[str, Any]
+    ) -> Tuple[str, int, Optional[Dict[str, Any]]]:
+        retriever_input = input.get("query_rewrite", {})
+        topic = (input.get("topic") or {}).get("type")
+        if topic:
+            retriever_input["topic"] = topic
+        k = self._k(input)
+        filter_model = MetadataValue(**retriever_input).to_dict(exclude_defaults=True)
+        filter = filter_model or None
+        query = retriever_input.get("query")  # reformulated key for vector retriever
+        logger.info(f"input: {input}, filter: {filter}")
+        return query, k, filter  # type: ignore
+
+    def _k(self, input: Dict[str, Any]) -> int:
+        k = self.settings.retriever.k
+        if input.get("chat_mode") == CHAT_MODE_SEARCH:
+            k = int(input.get("context_size", k) * SCALE_CONTEXT_RETREIVER)
+        return k
+
+    def speculative_search(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Search with the raw question, without filters, while the LLM stages are running.
+        Fetches speculative_scale times k, so that the filters can be applied afterwards.
+        """
+        time_st = time.time()
+        query = input.get("question", "")
+        limit = self._k(input) * self.settings.retriever.speculative_scale
+        embedding = self.db.embeddings.embed_query(query)  # type: ignore
+        docs_and_similarities = self.db.search_with_score(embedding, k=limit)
+        logger.info(
+            f"Elapsed time for speculative search: {time.time() - time_st:0.3f}"
+        )
+        return {
+            "query": query,
+            "embedding": embedding,
+            "limit": limit,
+            "docs_and_similarities": docs_and_similarities,
+        }
+
+    async def aspeculative_search(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        time_st = time.time()
+        query = input.get("question", "")
+        limit = self._k(input) * self.settings.retriever.speculative_scale
+        embedding = await self.db.embeddings.aembed_query(query)  # type: ignore
+        docs_and_similarities = await self.db.asearch_with_score(embedding, k=limit)
+        logger.info(
+            f"Elapsed time for speculative search: {time.time() - time_st:0.3f}"
+        )
+        return {
+            "query": query,
+            "embedding": embedding,
+            "limit": limit,
+            "docs_and_similarities": docs_and_similarities,
+        }
+
+    def speculative_chain(
+        self,
+    ) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
+        return RunnableLambda(
+            self.speculative_search, afunc=self.aspeculative_search
+        )  # type: ignore
+
+    def _speculative_hits(
+        self,
+        speculative: Optional[Dict[str, Any]],
+        query: str,
+        k: int,
+        filter: Optional[Dict[str, Any]],
+        embedding: Optional[Any] = None,
+    ) -> Optional[List[Tuple[Document, float]]]:
+        """
+        The top k of the speculative search after applying the filter, when it answers the rewritten query:
+        the queries are about the same, and enough hits are left after filtering to be the exact top k.
+        """
+        if not speculative:
+            return None
+        if normalize_query(query or "") != normalize_query(speculative["query"]):
+            if embedding is None:
+                return None
+            similarity = float(np.dot(embedding, speculative["embedding"]))
+            if similarity < self.settings.retriever.speculative_min_similarity:
+                logger.info(
+                    f"speculative search discarded, similarity: {similarity:0.4f}"
+                )
+                return None
+        hits = [
+            _ for _ in speculative["docs_and_similarities"] if self.db.matches(_[0], filter)
+        ]
+        # a truncated speculative search may miss filtered hits ranked below its limit
+        truncated = len(speculative["docs_and_similarities"]) >= speculative["limit"]
+        if len(hits) < k and truncated:
+            logger.info(f"speculative search discarded, {len(hits)} hits left by filter")
+            return None
+        logger.info("speculative search reused")
+        return hits[:k]
+
+    def _select_docs(
+        self, docs_and_similarities: List[Tuple[Document, float]]
+    ) -> Dict[str, Any]:
+        score_threshold = self.settings.retriever.score_threshold
+        docs = [doc for doc, _ in docs_and_similarities if _ >= score_threshold]
+        scores = [
+            score for _, score in docs_and_similarities if score >= score_threshold
+        ]
+        if scores:
+            logger.info(
+                f"score distribution: max={max(scores)} min={min(scores)} avg={sum(scores)/len(scores):0.4f}"
             )
-            filter = filter_model or None
-            query = retriever_input.get(
-                "query"
-            )  # reformulated key for vector retriever
-            logger.info(f"input: {input}, filter: {filter}")
-            docs_and_similarities = self.db.similarity_search_with_score(
-                query,
-                k=k,
-                filter=filter,  # type: ignore
+        if not len(docs):
+            logger.warning(
+                f"no relevant documents found with score threshold: {self.settings.retriever.score_threshold}!"
             )
-            score_threshold = self.settings.retriever.score_threshold
-            docs = [doc for doc, _ in docs_and_similarities if _ >= score_threshold]
-            scores = [
-                score for _, score in docs_and_similarities if score >= score_threshold
-            ]
-            if scores:
-                logger.info(
-                    f"score distribution: max={max(scores)} min={min(scores)} avg={sum(scores)/len(scores):0.4f}"
+            # use top - 2
+            docs = [doc for doc, _ in docs_and_similarities][:2]
+            scores = [score for _, score in docs_and_similarities][:2]
+        return {
+            "vector_docs": docs,
+            "vector_scores": scores,
+        }
+
+    def vector_search(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        time_st = time.time()
+        query, k, filter = self.search_params(input)
+        key, generation, hits = self._cached_hits(query, k, filter)
+        speculative = input.get("speculative")
+        if hits is not None:
+            docs_and_similarities = self.db.documents_by_ids(hits)
+        else:
+            embedding = None
+            if speculative is None or normalize_query(query or "") != normalize_query(
+                speculative["query"]
+            ):
+                embedding = self.db.embeddings.embed_query(query)  # type: ignore
+            docs_and_similarities = self._speculative_hits(
+                speculative, query, k, filter, embedding
+            )
+            # hits of a similar but different query are not cached as the hits of this one
+            approximate = docs_and_similarities is not None and embedding is not None
+            if docs_and_similarities is None:
+                if embedding is None:
+                    embedding = speculative["embedding"]  # type: ignore
+                docs_and_similarities = self.db.search_with_score(
+                    embedding, k=k, filter=filter
                 )
-            if not len(docs):
-                logger.warning(
-                    f"no relevant documents found with score threshold: {self.settings.retriever.score_threshold}!"
+            if not approximate:
+                self._cache_hits(key, generation, docs_and_similarities)
+        output = self._select_docs(docs_and_similarities)
+        logger.info(f"Elapsed time for vector search: {time.time() - time_st:0.3f}")
+        return output
+
+    async def avector_search(self, input: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Same as vector_search, but the query embedding runs on the embedding executor
+        and the search on the async Qdrant client, so the event loop keeps serving other requests.
+        """
+        time_st = time.time()
+        query, k, filter = self.search_params(input)
+        key, generation, hits = self._cached_hits(query, k, filter)
+        speculative = input.get("speculative")
+        if hits is not None:
+            docs_and_similarities = await self.db.adocuments_by_ids(hits)
+        else:
+            embedding = None
+            if speculative is None or normalize_query(query or "") != normalize_query(
+                speculative["query"]
+            ):
+                embedding = await self.db.embeddings.aembed_query(query)  # type: ignore
+            docs_and_similarities = self._speculative_hits(
+                speculative, query, k, filter, embedding
+            )
+            # hits of a similar but different query are not cached as the hits of this one
+            approximate = docs_and_similarities is not None and embedding is not None
+            if docs_and_similarities is None:
+                if embedding is None:
+                    embedding = speculative["embedding"]  # type: ignore
+                docs_and_similarities = await self.db.asearch_with_score(
+                    embedding, k=k, filter=filter
                 )
-                # use top - 2
-                docs = [doc for doc, _ in docs_and_similarities][:2]
-            logger.info(f"Elapsed time for vector search: {time.time() - time_st:0.3f}")
-            return {
-                "vector_docs": docs,
-            }
+            if not approximate:
+                self._cache_hits(key, generation, docs_and_similarities)
+        output = self._select_docs(docs_and_similarities)
+        logger.info(f"Elapsed time for vector search: {time.time() - time_st:0.3f}")
+        return output
 
+    def chain(self) -> RunnableSerializable[Dict[str, Any], Dict[str, Any]]:
         return TransformChain(
-            transform=vector_search,
+            transform=self.vector_search,
+            atransform=self.avector_search,
             input_variables=["query_rewrite", "topic", "chat_mode", "context_size"],
-            output_variables=["vector_docs"],
+            output_variables=["vector_docs", "vector_scores"],
         )  # type: ignore
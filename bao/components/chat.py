@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import re
 from typing import AsyncIterable, Awaitable, Iterable, List, Tuple, Union
 
 from injector import inject, singleton
@@ -125,7 +126,7 @@ class Chat:
     ) -> ChatResponse:
         question, history_msg, search = self.parse_input(input)
         if search:
-            chain = self.chat_chain.retriever_chain(fallback)
+            chain = self.chat_chain.search_chain(fallback)
             question = question[2:].strip()
         else:
             chain = self.chat_chain.chat_chain(fallback)
@@ -183,13 +184,19 @@ class Chat:
             }
         )
         docs = retriever_res.get("input_documents", [])
-        if docs:
+        if docs and retriever_res.get("answer_cache_hit"):
+            # replay the cached answer word by word
+            for token in re.findall(r"\s*\S+", retriever_res.get("output_text", "")):
+                yield token
+            ref_str = self.gen_source(show_all_source=True, docs=docs)
+            yield ChatResponse(answer="", reference=ref_str).response_text()
+        elif docs:
             ref_str = self.gen_source(show_all_source=True, docs=docs)
             callback_handler = AsyncIteratorCallbackHandler()
             # Begin a task that runs in the background.
             task = asyncio.create_task(
                 wrap_done(
-                    self.chat_chain.answer.chain().ainvoke(
+                    self.chat_chain.answer_chain().ainvoke(
                         {
                             "question": question,
                             "chat_history": history_msg,
@@ -204,7 +211,9 @@ class Chat:
             async for token in callback_handler.aiter():
                 yield token
 
-            await task
+            answer = await task
+            if answer:
+                self.chat_chain.answer_cache.store({**retriever_res, **answer})
             yield ChatResponse(answer="", reference=ref_str).response_text()
         else:
             yield ChatResponse(answer=retriever_res.get("output_text", "")).response_text()  # type: ignore
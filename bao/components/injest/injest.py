@@ -23,6 +23,12 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument("--injest", action="store_true", help="Data injest", required=False)
+parser.add_argument(
+    "--bulk",
+    action="store_true",
+    help="Bulk load with parallel uploads and deferred indexing, for initial loads",
+    required=False,
+)
 parser.add_argument(
     "--remove", action="store_true", help="Data deletion", required=False
 )
@@ -40,7 +46,7 @@ args = parser.parse_args()
 if __name__ == "__main__":
     injest_service = global_injector.get(InjestService)
     if args.injest:
-        injest_service.injest_folder()
+        injest_service.injest_folder(bulk=args.bulk)
     elif args.remove:
         meta_key = args.filter_key
         meta_values = args.filter_value.split(",")
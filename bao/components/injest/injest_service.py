@@ -1,5 +1,7 @@
+import asyncio
 import os
 import tempfile
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Any, BinaryIO, Dict, List, Optional, get_args
 
@@ -30,7 +32,7 @@ from tqdm.auto import tqdm
 
 from bao.components import TOPIC_TYPE
 from bao.settings.settings import Settings
-from bao.utils.injest_event_sync import InjestEventSync
+from bao.utils.grader_verdict_cache import GraderVerdictCache
 from bao.utils.strings import extract_times_to_seconds, get_metadata_alias
 
 logger = logging.getLogger(__name__)
@@ -48,9 +50,13 @@ class InjestService:
         )
         self.app_name = self.settings.retriever.collection_name
         self.db = db
-        # make sure the source folder is there
-        Path(self.settings.injest.injest_from).mkdir(parents=True, exist_ok=True)
-        self.event_sync = InjestEventSync(db_root=self.settings.injest.injest_from)
+        # the event log shared with the replica and the caches of the db
+        self.event_sync = db.event_sync
+        self.verdict_cache = None
+        if self.settings.grader.verdict_cache_path:
+            self.verdict_cache = GraderVerdictCache(
+                db_root=self.settings.grader.verdict_cache_path
+            )
 
     def _find_all_entries(self) -> List[Path]:
         """
@@ -86,15 +92,40 @@ class InjestService:
                 f.write(content)
             return self.injest_file(yaml_f)
 
-    def injest_file(self, yaml_file_path: Path) -> List[Document]:
+    async def ainjest_bin(self, yaml_bin: BinaryIO, yaml_fname: str) -> List[Document]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yaml_f = Path(temp_dir) / yaml_fname
+            with open(yaml_f, "wb") as f:
+                content = yaml_bin.read()
+                f.write(content)
+            return await self.ainjest_file(yaml_f)
+
+    def _load_file_documents(self, yaml_file_path: Path) -> List[Document]:
         entry = yaml_file_path
         if not entry.exists() or not entry.is_file():
             raise ValueError(
                 f"param value for yaml_file_path : {yaml_file_path} is invalid."
             )
-        docs = self._injest_entry(Path(yaml_file_path))
-        self.db.add_documents(docs)
+        return self._injest_entry(Path(yaml_file_path))
+
+    def _record_upsert(self, docs: List[Document]) -> None:
         self.event_sync.batch_insert_event(self.app_name, [docs[0].metadata.get(SOURCE_KEY)])  # type: ignore
+        self.event_sync.append_log(self.app_name, "upsert", SOURCE_KEY, [docs[0].metadata.get(SOURCE_KEY)])  # type: ignore
+
+    def injest_file(self, yaml_file_path: Path) -> List[Document]:
+        docs = self._load_file_documents(yaml_file_path)
+        self.db.upsert_sources(docs)
+        self._record_upsert(docs)
+        return docs
+
+    async def ainjest_file(self, yaml_file_path: Path) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        # file parsing, splitting and the sqlite event log stay off the event loop
+        docs = await loop.run_in_executor(
+            None, self._load_file_documents, yaml_file_path
+        )
+        await self.db.aupsert_sources(docs)
+        await loop.run_in_executor(None, self._record_upsert, docs)
         return docs
 
     def _injest_entry(self, entry_yaml: Path) -> List[Document]:
@@ -128,16 +159,21 @@ class InjestService:
             d.metadata[CHUNK_NO_KEY] = chunk_no
         return documents
 
-    def _injest_from_folder(self):
+    def _injest_from_folder(self, bulk: bool = False):
         """
         Reads all .txt files in the given directory
-
+        In bulk mode, the documents are uploaded in parallel batches with indexing deferred to the end.
         """
 
         def sync():
             if buff_window:
-                self.db.add_documents(buff_window)
-                synced_entries.extend([d.metadata[SOURCE_KEY] for d in buff_window])
+                if bulk:
+                    self.db.bulk_upload(buff_window)
+                else:
+                    self.db.upsert_sources(buff_window)
+                sources = [d.metadata[SOURCE_KEY] for d in buff_window]
+                self.event_sync.append_log(self.app_name, "upsert", SOURCE_KEY, sources)
+                synced_entries.extend(sources)
                 buff_window.clear()
 
         def add_to_buffer(documents: List[Document]):
@@ -160,30 +196,37 @@ class InjestService:
         total_num_pages = 0
 
         root_directory = Path(root_directory)
-        for entry_yaml in tqdm(yaml_entries):
-            documents = self._injest_entry(entry_yaml)
-            add_to_buffer(documents)
-            total_num_pages += 1
-        sync()
+        # the embedding worker processes only live for the folder ingestion
+        with (
+            self.db.deferred_indexing() if bulk else nullcontext(),
+            self.db.embeddings.worker_processes(),  # type: ignore
+        ):
+            for entry_yaml in tqdm(yaml_entries):
+                documents = self._injest_entry(entry_yaml)
+                add_to_buffer(documents)
+                total_num_pages += 1
+            sync()
+        if bulk:
+            self.db.wait_indexed(timeout=self.settings.injest.bulk_index_timeout)
         self.event_sync.batch_insert_event(self.app_name, list(set(synced_entries)))
         logger.info(f"total #pages processed: {total_num_pages}")
         logger.info(f"total #documents: {total_num_docs}")
 
-    def injest_folder(self):
+    def injest_folder(self, bulk: bool = False):
         logger.info("Begin data injest ...")
         logger.info(f"injest operation on {self.settings.retriever.collection_name}")
-        self._injest_from_folder()
+        self._injest_from_folder(bulk=bulk)
         logger.info("Done.")
 
-    def remove(self, source_key: str, source_values: List[str]) -> None:
-        """Remove by sources"""
-        logger.info(f"del operation on {self.settings.retriever.collection_name}")
+    def _source_filter(
+        self, source_key: str, source_values: List[str]
+    ) -> models.Filter:
         if source_key not in get_metadata_alias(self.settings.retriever.metadata):
             raise ValueError(f"{source_key} is invalid metadata field.")
         if not source_values:
             raise ValueError(f"param: meta_value is empty.")
         # find all related record ids
-        filters = models.Filter(
+        return models.Filter(
             must=[
                 models.FieldCondition(
                     key=f"metadata.{source_key}",
@@ -191,12 +234,24 @@ class InjestService:
                 )
             ]
         )
-        points_selector = models.FilterSelector(filter=filters)
-        self.db.client.delete(
-            collection_name=self.settings.retriever.collection_name,
-            points_selector=points_selector,
-        )
+
+    def _remove_verdicts(self, source_key: str, source_values: List[str]) -> None:
+        """Drop the cached grader verdicts of the removed chunks"""
+        if self.verdict_cache is None:
+            return
+        if source_key == SOURCE_KEY:
+            self.verdict_cache.remove_sources(source_values)
+        else:
+            # verdicts only remember the source of their chunks
+            self.verdict_cache.clear()
+
+    def remove(self, source_key: str, source_values: List[str]) -> None:
+        """Remove by sources"""
+        logger.info(f"del operation on {self.settings.retriever.collection_name}")
+        self.db.delete_by_filter(self._source_filter(source_key, source_values))
         self.event_sync.remove(self.app_name, source_values)
+        self.event_sync.append_log(self.app_name, "remove", source_key, source_values)
+        self._remove_verdicts(source_key, source_values)
 
     def list_sources(self, title_like: Optional[str] = None) -> List[List[str]]:
         """
@@ -1,29 +1,956 @@
-from bao.settings.settings import Settings
+import asyncio
+import logging
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    get_args,
+)
+
+from bao.components import TOPIC_TYPE
+from bao.components.injest import CHUNK_NO_KEY, SOURCE_KEY, TOPIC_KEY
+from bao.settings.settings import QdrantCollectionSettings, Settings
+import grpc
 from qdrant_client.http import models
-from qdrant_client import QdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from langchain_community.vectorstores.qdrant import Qdrant
+from langchain_core.documents import Document
 
+from bao.utils.chunk_text_store import ChunkTextStore
 from bao.utils.embeddings import EmbeddingsCache
+from bao.utils.injest_event_sync import InjestEventSync
+from bao.utils.vector_replica import VectorReplica
 from injector import singleton, inject
 
+logger = logging.getLogger(__name__)
+
+# Qdrant default of optimizers_config.indexing_threshold (in KB)
+DEFAULT_INDEXING_THRESHOLD = 20000
+
+PAYLOAD_SCHEMA_TYPES = {
+    "str": models.PayloadSchemaType.KEYWORD,
+    "int": models.PayloadSchemaType.INTEGER,
+}
+
+
+class Shard(NamedTuple):
+    """Where the points of a topic live: a collection, and the custom shard key in it"""
+
+    collection_name: str
+    shard_key: Optional[str] = None
+
 
 @singleton
 class QdrantVectorDB(Qdrant):
     @inject
     def __init__(self, settings: Settings):
+        self.settings = settings
         embeddings = EmbeddingsCache()
-        client = QdrantClient(**settings.qdrant.model_dump(exclude_unset=True))
+        client = QdrantClient(**settings.qdrant.client_params())
+        # QdrantLocal cannot be shared by a sync and an async client,
+        # async calls then run the sync client on a worker thread
+        async_client = None
+        if not settings.qdrant.path and settings.qdrant.location != ":memory:":
+            async_client = AsyncQdrantClient(**settings.qdrant.client_params())
         collection_name = settings.retriever.collection_name
+        super().__init__(
+            client=client,
+            collection_name=collection_name,
+            embeddings=embeddings,
+            async_client=async_client,
+        )
+        self.text_store = None
+        if settings.qdrant.collection.external_text:
+            self.text_store = ChunkTextStore(
+                db_root=settings.qdrant.collection.text_store_path,
+                collection_name=collection_name,
+            )
+        Path(settings.injest.injest_from).mkdir(parents=True, exist_ok=True)
+        # the injest event log, shared by the replica, the caches and the ingestion
+        self.event_sync = InjestEventSync(
+            db_root=settings.injest.injest_from,
+            head_check_interval=settings.injest.log_check_interval,
+        )
+        self.topic_shards = self._topic_shards()
+        # fans the searches of per-topic collections out in parallel
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.shards()), 1))
+        for name in self.collection_names():
+            self._bootstrap_collection(name)
+        self.replica = None
+        if settings.qdrant.replica.enabled:
+            self._init_replica()
+
+    def _init_replica(self) -> None:
+        self.replica = VectorReplica(
+            dim=self.settings.embedding.embedding_size,
+            metadata_key=self.metadata_payload_key,
+            dtype=self.settings.qdrant.replica.dtype,
+        )
+        # injest log id the replica is synced to
+        self._replica_log_id: Optional[int] = None
+        self._replica_refresh: Optional[Future] = None
+        self._replica_executor = ThreadPoolExecutor(max_workers=1)
+        self._refresh_replica_in_background()
+
+    def _topic_shards(self) -> Dict[str, Shard]:
+        retriever = self.settings.retriever
+        if retriever.sharding == "none":
+            return {}
+        if retriever.sharding == "shard_key" and self.async_client is None:
+            raise ValueError(
+                "retriever.sharding=shard_key needs a Qdrant server, QdrantLocal does not support custom sharding."
+            )
+        topics = retriever.shard_topics or [
+            _ for _ in get_args(TOPIC_TYPE) if _ != "greeting"
+        ]
+        if self.settings.injest.default_topic not in topics:
+            raise ValueError(
+                f"injest.default_topic: {self.settings.injest.default_topic} is not in the shard topics: {topics}"
+            )
+        if retriever.sharding == "collection":
+            return {t: Shard(f"{self.collection_name}_{t}") for t in topics}
+        return {t: Shard(self.collection_name, t) for t in topics}
+
+    def shards(self) -> List[Shard]:
+        """All the shards of the collection"""
+        return list(self.topic_shards.values()) or [Shard(self.collection_name)]
+
+    def shard_of(self, document: Document) -> Shard:
+        """Shard the document is written to, by its topic"""
+        if not self.topic_shards:
+            return Shard(self.collection_name)
+        topic = document.metadata.get(TOPIC_KEY)
+        if topic not in self.topic_shards:
+            topic = self.settings.injest.default_topic
+        return self.topic_shards[topic]
+
+    def _route(
+        self, filter: Optional[Dict[str, Any]]
+    ) -> Tuple[List[Shard], Optional[Dict[str, Any]]]:
+        """
+        Shards to search for the topic in the filter.
+        The topic condition is dropped then, the shard already holds only that topic.
+        Other topics fan out to all the shards.
+        """
+        if not self.topic_shards:
+            return [Shard(self.collection_name)], filter
+        filter = dict(filter or {})
+        topic = filter.pop(TOPIC_KEY, None)
+        if topic in self.topic_shards:
+            return [self.topic_shards[topic]], filter or None
+        logger.info(f"topic: {topic} has no shard, search all shards")
+        if self.settings.retriever.sharding == "shard_key":
+            # without a shard key selector, Qdrant searches every shard of the collection
+            return [Shard(self.collection_name)], filter or None
+        return self.shards(), filter or None
+
+    def matches(self, document: Document, filter: Optional[Dict[str, Any]]) -> bool:
+        """Whether a search with the filter can return the document, to post-filter a broader search"""
+        topic = (filter or {}).get(TOPIC_KEY)
+        if topic in self.topic_shards:
+            if self.shard_of(document) != self.topic_shards[topic]:
+                return False
+        if self.topic_shards:
+            filter = self._route(filter)[1]
+        for key, value in (filter or {}).items():
+            if isinstance(value, list):
+                if document.metadata.get(key) not in value:
+                    return False
+            elif document.metadata.get(key) != value:
+                return False
+        return True
+
+    def _bootstrap_collection(self, collection_name: str) -> None:
+        config = self.settings.qdrant.collection
+        custom_sharding = self.settings.retriever.sharding == "shard_key"
         if collection_name not in [
-            _.name for _ in client.get_collections().collections
+            _.name for _ in self.client.get_collections().collections
         ]:
-            client.create_collection(
+            self.client.create_collection(
                 collection_name=collection_name,
                 vectors_config=models.VectorParams(
-                    size=settings.embedding.embedding_size,
+                    size=self.settings.embedding.embedding_size,
                     distance=models.Distance.COSINE,
+                    on_disk=config.on_disk_vectors,
+                ),
+                on_disk_payload=config.on_disk_payload,
+                hnsw_config=models.HnswConfigDiff(
+                    m=config.hnsw_m, ef_construct=config.hnsw_ef_construct
+                ),
+                quantization_config=self._quantization_config(config),  # type: ignore
+                sharding_method=(
+                    models.ShardingMethod.CUSTOM if custom_sharding else None
                 ),
             )
-        super().__init__(
-            client=client, collection_name=collection_name, embeddings=embeddings
+        elif config.reconcile:
+            self._reconcile_collection(collection_name, config)
+        if custom_sharding:
+            self._ensure_shard_keys(collection_name)
+        # QdrantLocal ignores payload indexes and warns about them on every startup
+        if config.payload_indexes and self.async_client is not None:
+            self._ensure_payload_indexes(collection_name)
+
+    def _ensure_shard_keys(self, collection_name: str) -> None:
+        params = self.client.get_collection(collection_name).config.params
+        if params.sharding_method != models.ShardingMethod.CUSTOM:
+            raise ValueError(
+                f"collection {collection_name} was created without custom sharding. "
+                "Re-create it to use retriever.sharding=shard_key."
+            )
+        # read the existing keys first, a duplicate key raises differently over REST and gRPC
+        cluster = self.client.get_collection_cluster_info(collection_name)
+        existing = set(
+            [_.shard_key for _ in cluster.local_shards + cluster.remote_shards]
+        )
+        for shard in self.shards():
+            if shard.shard_key in existing:
+                continue
+            try:
+                self.client.create_shard_key(collection_name, shard.shard_key)  # type: ignore
+                logger.info(f"create shard key {shard.shard_key} of {collection_name}")
+            except UnexpectedResponse as e:
+                if b"already exists" not in (e.content or b""):
+                    raise
+            except grpc.RpcError as e:
+                # created by another process meanwhile
+                if e.code() != grpc.StatusCode.ALREADY_EXISTS and "already exists" not in (  # type: ignore
+                    e.details() or ""  # type: ignore
+                ):
+                    raise
+
+    @staticmethod
+    def _quantization_config(
+        config: QdrantCollectionSettings,
+    ) -> models.ScalarQuantization | None:
+        if not config.scalar_quantization:
+            return None
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=config.quantization_quantile,
+                always_ram=config.quantization_always_ram,
+            )
+        )
+
+    def _reconcile_collection(
+        self, collection_name: str, config: QdrantCollectionSettings
+    ) -> None:
+        """Update the existing collection where its config differs from the settings"""
+        current = self.client.get_collection(collection_name).config
+        update = {}
+        hnsw = {
+            "m": config.hnsw_m,
+            "ef_construct": config.hnsw_ef_construct,
+        }
+        hnsw = {
+            k: v
+            for k, v in hnsw.items()
+            if v is not None and getattr(current.hnsw_config, k) != v
+        }
+        if hnsw:
+            update["hnsw_config"] = models.HnswConfigDiff(**hnsw)
+        vector_params = current.params.vectors
+        if (
+            config.on_disk_vectors is not None
+            and isinstance(vector_params, models.VectorParams)
+            and bool(vector_params.on_disk) != config.on_disk_vectors
+        ):
+            update["vectors_config"] = {
+                "": models.VectorParamsDiff(on_disk=config.on_disk_vectors)
+            }
+        if (
+            config.on_disk_payload is not None
+            and bool(current.params.on_disk_payload) != config.on_disk_payload
+        ):
+            update["collection_params"] = models.CollectionParamsDiff(
+                on_disk_payload=config.on_disk_payload
+            )
+        quantization = self._quantization_config(config)
+        if quantization is not None and current.quantization_config != quantization:
+            update["quantization_config"] = quantization
+        elif quantization is None and current.quantization_config is not None:
+            update["quantization_config"] = models.Disabled.DISABLED
+        if update:
+            logger.info(f"update config of collection {collection_name}: {update}")
+            self.client.update_collection(collection_name=collection_name, **update)
+
+    def _payload_index_schema(self) -> Dict[str, models.PayloadSchemaType]:
+        """Payload index types of the fields declared in retriever.metadata"""
+        metadata = self.settings.retriever.metadata
+        schema = {}
+        for name, field in metadata.model_fields.items():
+            field_type = getattr(metadata, name)
+            if field_type in PAYLOAD_SCHEMA_TYPES:
+                key = f"{self.metadata_payload_key}.{field.alias or name}"
+                schema[key] = PAYLOAD_SCHEMA_TYPES[field_type]
+        return schema
+
+    def _ensure_payload_indexes(self, collection_name: str) -> None:
+        existing = self.client.get_collection(collection_name).payload_schema
+        for field_name, field_schema in self._payload_index_schema().items():
+            if field_name in existing:
+                continue
+            logger.info(
+                f"create payload index on {collection_name}: {field_name} ({field_schema})"
+            )
+            self.client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=field_schema,
+            )
+
+    @staticmethod
+    def _vector(embedding: Sequence[float]) -> List[float]:
+        return embedding.tolist() if hasattr(embedding, "tolist") else list(embedding)  # type: ignore
+
+    def _build_points(
+        self,
+        documents: List[Document],
+        vectors: Sequence[Sequence[float]],
+        ids: Optional[Sequence[str]] = None,
+    ) -> List[models.PointStruct]:
+        ids = ids or [uuid.uuid4().hex for _ in documents]
+        return [
+            models.PointStruct(id=point_id, vector=self._vector(vector), payload=payload)
+            for point_id, vector, payload in zip(ids, vectors, self._payloads(documents))
+        ]
+
+    def _payloads(self, documents: List[Document]) -> List[Dict[str, Any]]:
+        """With the external text store, only the metadata is kept in the payload"""
+        return self._build_payloads(
+            ["" if self.text_store else _.page_content for _ in documents],
+            [_.metadata for _ in documents],
+            self.content_payload_key,
+            self.metadata_payload_key,
+        )
+
+    def _store_texts(
+        self, documents: List[Document], points: List[models.PointStruct]
+    ) -> None:
+        if self.text_store is not None:
+            self.text_store.put_many(
+                [(str(p.id), d.page_content) for d, p in zip(documents, points)]
+            )
+
+    def _fill_texts(self, documents: List[Document]) -> List[Document]:
+        """Fetch the texts of the ranked documents from the text store in one lookup"""
+        if self.text_store is not None and documents:
+            texts = self.text_store.get_many([_.metadata["_id"] for _ in documents])
+            for d in documents:
+                d.page_content = texts.get(str(d.metadata["_id"]), "")
+        return documents
+
+    def _to_documents(
+        self, shard_results: Sequence[Tuple[Shard, List[models.ScoredPoint]]], k: int
+    ) -> List[Tuple[Document, float]]:
+        """Merge the hits of the searched shards by score into the top k documents"""
+        hits = sorted(
+            [(shard, point) for shard, points in shard_results for point in points],
+            key=lambda _: _[1].score,
+            reverse=True,
+        )[:k]
+        documents = [
+            self._document_from_scored_point(
+                point,
+                shard.collection_name,
+                self.content_payload_key,
+                self.metadata_payload_key,
+            )
+            for shard, point in hits
+        ]
+        self._fill_texts(documents)
+        return [(d, point.score) for d, (_, point) in zip(documents, hits)]
+
+    def _group_by_shard(
+        self, documents: List[Document], items: Sequence[Any]
+    ) -> Dict[Shard, List[Any]]:
+        """Group the points (or point ids) of the documents by the shards of the documents"""
+        grouped: Dict[Shard, List[Any]] = defaultdict(list)
+        for document, item in zip(documents, items):
+            grouped[self.shard_of(document)].append(item)
+        return grouped
+
+    async def _run_sync(self, fn, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(fn, *args, **kwargs)
+        )
+
+    def _search_shard(
+        self,
+        shard: Shard,
+        embedding: Sequence[float],
+        k: int,
+        filter: Optional[Dict[str, Any]],
+    ) -> List[models.ScoredPoint]:
+        return self.client.search(
+            collection_name=shard.collection_name,
+            query_vector=self._vector(embedding),
+            query_filter=self._qdrant_filter_from_dict(filter),
+            limit=k,
+            with_payload=True,
+            shard_key_selector=shard.shard_key,
+        )
+
+    def _replica_points(
+        self, filter: Optional[models.Filter]
+    ) -> Tuple[List[str], List[List[float]], List[Dict[str, Any]], List[str]]:
+        ids, vectors, payloads, collections = [], [], [], []
+        for shard in self.shards():
+            for record in self._scroll(
+                shard, filter, with_payload=True, with_vectors=True
+            ):
+                ids.append(str(record.id))
+                vectors.append(record.vector)
+                payloads.append(record.payload or {})
+                collections.append(shard.collection_name)
+        return ids, vectors, payloads, collections  # type: ignore
+
+    def refresh_replica(self) -> None:
+        """Bring the replica up to the head of the injest event log"""
+        config = self.settings.qdrant.replica
+        head = self.event_sync.last_log_id(self.collection_name)
+        records = []
+        if self._replica_log_id is not None:
+            records = self.event_sync.log_since(self.collection_name, self._replica_log_id)
+        if self._replica_log_id is None or len(records) > config.full_reload_after:
+            n_points = sum(
+                [
+                    self.client.count(
+                        collection_name=shard.collection_name,
+                        shard_key_selector=shard.shard_key,
+                        exact=False,
+                    ).count
+                    for shard in self.shards()
+                ]
+            )
+            if n_points > config.max_points:
+                logger.warning(
+                    f"{self.collection_name} has {n_points} points, more than qdrant.replica.max_points: {config.max_points}. The replica is disabled."
+                )
+                self.replica = None
+                return
+            self.replica.load(*self._replica_points(None))  # type: ignore
+        else:
+            # re-read the changed sources, removed ones come back empty
+            changes: Dict[str, List[str]] = defaultdict(list)
+            for _, _, meta_key, meta_value in records:
+                changes[meta_key].append(meta_value)
+            ids, vectors, payloads, collections = [], [], [], []
+            for meta_key, meta_values in changes.items():
+                points = self._replica_points(
+                    models.Filter(
+                        must=[
+                            models.FieldCondition(
+                                key=f"{self.metadata_payload_key}.{meta_key}",
+                                match=models.MatchAny(any=meta_values),
+                            )
+                        ]
+                    )
+                )
+                for result, values in zip((ids, vectors, payloads, collections), points):
+                    result.extend(values)  # type: ignore
+            self.replica.update(changes, ids, vectors, payloads, collections)  # type: ignore
+        self._replica_log_id = head
+        logger.info(
+            f"replica of {self.collection_name} synced to log id {head}: {len(self.replica)} points"  # type: ignore
+        )
+
+    def _refresh_replica(self) -> None:
+        try:
+            self.refresh_replica()
+        except Exception:
+            logger.exception(f"failed to refresh the replica of {self.collection_name}")
+
+    def _refresh_replica_in_background(self) -> None:
+        if self._replica_refresh is None or self._replica_refresh.done():
+            self._replica_refresh = self._replica_executor.submit(self._refresh_replica)
+
+    def _replica_fresh(self) -> bool:
+        """The replica has applied the whole injest log, as of the last lookup of its head"""
+        head = self.event_sync.head(self.collection_name)
+        if self._replica_log_id is not None and self._replica_log_id >= head:
+            return True
+        self._refresh_replica_in_background()
+        return False
+
+    def _search_replica(
+        self,
+        embedding: Sequence[float],
+        k: int,
+        filter: Optional[Dict[str, Any]],
+    ) -> Optional[List[Tuple[Document, float]]]:
+        """Search the replica when it is fresh. None tells to search the server."""
+        if self.replica is None or not self._replica_fresh():
+            return None
+        if self.topic_shards and (filter or {}).get(TOPIC_KEY) not in self.topic_shards:
+            _, filter = self._route(filter)
+        try:
+            hits = self.replica.search(self._vector(embedding), k, filter)
+        except ValueError as e:
+            logger.info(f"{e}, search the server")
+            return None
+        return self._to_documents(
+            [
+                (
+                    Shard(collection_name),
+                    [
+                        models.ScoredPoint(
+                            id=point_id, version=0, score=score, payload=payload
+                        )
+                    ],
+                )
+                for point_id, score, payload, collection_name in hits
+            ],
+            k,
+        )
+
+    def search_with_score(
+        self,
+        embedding: Sequence[float],
+        k: int,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        documents = self._search_replica(embedding, k, filter)
+        if documents is not None:
+            return documents
+        shards, filter = self._route(filter)
+        if len(shards) == 1:
+            results = [self._search_shard(shards[0], embedding, k, filter)]
+        else:
+            results = list(
+                self.executor.map(
+                    lambda shard: self._search_shard(shard, embedding, k, filter),
+                    shards,
+                )
+            )
+        return self._to_documents(list(zip(shards, results)), k)
+
+    async def asearch_with_score(
+        self,
+        embedding: Sequence[float],
+        k: int,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[Document, float]]:
+        if self.replica is not None:
+            # the freshness check, the matmul and the text lookups are blocking
+            documents = await self._run_sync(self._search_replica, embedding, k, filter)
+            if documents is not None:
+                return documents
+        if self.async_client is None:
+            return await self._run_sync(self.search_with_score, embedding, k, filter)
+        shards, filter = self._route(filter)
+        results = await asyncio.gather(
+            *[
+                self.async_client.search(
+                    collection_name=shard.collection_name,
+                    query_vector=self._vector(embedding),
+                    query_filter=self._qdrant_filter_from_dict(filter),
+                    limit=k,
+                    with_payload=True,
+                    shard_key_selector=shard.shard_key,
+                )
+                for shard in shards
+            ]
+        )
+        return self._to_documents(list(zip(shards, results)), k)
+
+    @staticmethod
+    def _hits_by_collection(
+        hits: Sequence[Tuple[str, str, float]]
+    ) -> Dict[str, Dict[str, float]]:
+        grouped: Dict[str, Dict[str, float]] = defaultdict(dict)
+        for point_id, collection_name, score in hits:
+            grouped[collection_name][point_id] = score
+        return grouped
+
+    @staticmethod
+    def _scored_points(
+        records: List[models.Record], scores: Dict[str, float]
+    ) -> List[models.ScoredPoint]:
+        return [
+            models.ScoredPoint(
+                id=_.id, version=0, score=scores[str(_.id)], payload=_.payload
+            )
+            for _ in records
+        ]
+
+    def documents_by_ids(
+        self, hits: Sequence[Tuple[str, str, float]]
+    ) -> List[Tuple[Document, float]]:
+        """Load the documents of ranked hits: (point id, collection name, score)"""
+        shard_results = []
+        for collection_name, scores in self._hits_by_collection(hits).items():
+            records = self.client.retrieve(
+                collection_name=collection_name, ids=list(scores), with_payload=True
+            )
+            shard_results.append(
+                (Shard(collection_name), self._scored_points(records, scores))
+            )
+        return self._to_documents(shard_results, len(hits))
+
+    async def adocuments_by_ids(
+        self, hits: Sequence[Tuple[str, str, float]]
+    ) -> List[Tuple[Document, float]]:
+        if self.async_client is None:
+            return await self._run_sync(self.documents_by_ids, hits)
+        grouped = self._hits_by_collection(hits)
+        results = await asyncio.gather(
+            *[
+                self.async_client.retrieve(
+                    collection_name=collection_name, ids=list(scores), with_payload=True
+                )
+                for collection_name, scores in grouped.items()
+            ]
+        )
+        return self._to_documents(
+            [
+                (Shard(collection_name), self._scored_points(records, scores))
+                for (collection_name, scores), records in zip(grouped.items(), results)
+            ],
+            len(hits),
+        )
+
+    def upsert_documents(
+        self, documents: List[Document], ids: Optional[Sequence[str]] = None
+    ) -> List[str]:
+        """Embed and upsert the documents into the shards of their topics. Returns the point ids."""
+        vectors = self.embeddings.embed_documents([_.page_content for _ in documents])  # type: ignore
+        points = self._build_points(documents, vectors, ids)
+        self._store_texts(documents, points)
+        for shard, shard_points in self._group_by_shard(documents, points).items():
+            self.client.upsert(
+                collection_name=shard.collection_name,
+                points=shard_points,
+                shard_key_selector=shard.shard_key,
+            )
+        return [_.id for _ in points]  # type: ignore
+
+    async def aupsert_documents(
+        self, documents: List[Document], ids: Optional[Sequence[str]] = None
+    ) -> List[str]:
+        if self.async_client is None:
+            return await self._run_sync(self.upsert_documents, documents, ids)
+        vectors = await self.embeddings.aembed_documents(  # type: ignore
+            [_.page_content for _ in documents]
+        )
+        points = self._build_points(documents, vectors, ids)
+        self._store_texts(documents, points)
+        await asyncio.gather(
+            *[
+                self.async_client.upsert(
+                    collection_name=shard.collection_name,
+                    points=shard_points,
+                    shard_key_selector=shard.shard_key,
+                )
+                for shard, shard_points in self._group_by_shard(
+                    documents, points
+                ).items()
+            ]
+        )
+        return [_.id for _ in points]  # type: ignore
+
+    def _scroll(
+        self, shard: Shard, filter: Optional[models.Filter], **kwargs
+    ) -> Iterator[models.Record]:
+        offset = None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=shard.collection_name,
+                scroll_filter=filter,
+                limit=1000,
+                offset=offset,
+                shard_key_selector=shard.shard_key,
+                **kwargs,
+            )
+            yield from records
+            if offset is None:
+                return
+
+    def topic_vectors(self, topic: str, limit: int) -> List[List[float]]:
+        """Vectors of up to `limit` points of the topic"""
+        filter = models.Filter(
+            must=[
+                models.FieldCondition(
+                    key=f"{self.metadata_payload_key}.{TOPIC_KEY}",
+                    match=models.MatchValue(value=topic),
+                )
+            ]
+        )
+        vectors: List[List[float]] = []
+        for shard in self._route({TOPIC_KEY: topic})[0]:
+            for record in self._scroll(
+                shard, filter, with_payload=False, with_vectors=True
+            ):
+                vectors.append(record.vector)  # type: ignore
+                if len(vectors) >= limit:
+                    return vectors
+        return vectors
+
+    def _point_ids_by_filter(self, shard: Shard, filter: models.Filter) -> List[str]:
+        return [str(_.id) for _ in self._scroll(shard, filter, with_payload=False)]
+
+    def delete_by_filter(
+        self,
+        filter: models.Filter,
+        shards: Optional[List[Shard]] = None,
+        keep_texts: Sequence[str] = (),
+    ) -> None:
+        """
+        Delete the matched points from the given shards, from all the shards by default.
+        The texts of `keep_texts` stay in the text store: the ids do not tell the shards apart,
+        a point moved to another shard keeps its id and its text.
+        """
+        kept = set(keep_texts)
+        for shard in shards or self.shards():
+            if self.text_store is not None:
+                self.text_store.remove(
+                    [_ for _ in self._point_ids_by_filter(shard, filter) if _ not in kept]
+                )
+            self.client.delete(
+                collection_name=shard.collection_name,
+                points_selector=models.FilterSelector(filter=filter),
+                shard_key_selector=shard.shard_key,
+            )
+
+    async def adelete_by_filter(
+        self,
+        filter: models.Filter,
+        shards: Optional[List[Shard]] = None,
+        keep_texts: Sequence[str] = (),
+    ) -> None:
+        if self.async_client is None or self.text_store is not None:
+            return await self._run_sync(
+                self.delete_by_filter, filter, shards, keep_texts
+            )
+        await asyncio.gather(
+            *[
+                self.async_client.delete(
+                    collection_name=shard.collection_name,
+                    points_selector=models.FilterSelector(filter=filter),
+                    shard_key_selector=shard.shard_key,
+                )
+                for shard in shards or self.shards()
+            ]
         )
+
+    def point_ids(self, documents: List[Document]) -> List[str]:
+        """Point ids derived from (collection, source, chunk-no), so that re-ingestion overwrites in place"""
+        return [
+            str(
+                uuid.uuid5(
+                    uuid.NAMESPACE_URL,
+                    f"{self.collection_name}/{_.metadata.get(SOURCE_KEY)}/{_.metadata.get(CHUNK_NO_KEY)}",
+                )
+            )
+            for _ in documents
+        ]
+
+    def _changed_documents(
+        self,
+        documents: List[Document],
+        ids: List[str],
+        existing: List[models.Record],
+    ) -> Tuple[List[Document], List[str]]:
+        existing_payloads = {str(_.id): _.payload for _ in existing}
+        existing_texts = {}
+        if self.text_store is not None:
+            existing_texts = self.text_store.get_many(ids)
+        changed = [
+            i
+            for i, (point_id, payload) in enumerate(zip(ids, self._payloads(documents)))
+            if existing_payloads.get(point_id) != payload
+            or (
+                self.text_store is not None
+                and existing_texts.get(point_id) != documents[i].page_content
+            )
+        ]
+        logger.info(f"{len(changed)} of {len(documents)} chunks changed")
+        return [documents[i] for i in changed], [ids[i] for i in changed]
+
+    def _stale_chunks_filters(
+        self, documents: List[Document], ids: List[str]
+    ) -> List[Tuple[List[Shard], models.Filter]]:
+        """
+        Points of the given sources other than the new ones `ids`,
+        e.g. the chunks beyond the new chunk count or points written with other ids before,
+        and the points left in other shards when the topic of a source changed.
+        """
+        source_key = f"{self.metadata_payload_key}.{SOURCE_KEY}"
+        source_shards = {_.metadata.get(SOURCE_KEY): self.shard_of(_) for _ in documents}
+        source_ids: Dict[str, List[str]] = defaultdict(list)
+        for document, point_id in zip(documents, ids):
+            source_ids[document.metadata.get(SOURCE_KEY)].append(point_id)  # type: ignore
+        stale = [
+            (
+                [source_shards[source]],
+                models.Filter(
+                    must=[
+                        models.FieldCondition(
+                            key=source_key, match=models.MatchValue(value=source)
+                        ),
+                    ],
+                    must_not=[models.HasIdCondition(has_id=point_ids)],  # type: ignore
+                ),
+            )
+            for source, point_ids in source_ids.items()
+        ]
+        if self.topic_shards:
+            for shard in self.shards():
+                moved = [s for s, s_shard in source_shards.items() if s_shard != shard]
+                if moved:
+                    stale.append(
+                        (
+                            [shard],
+                            models.Filter(
+                                must=[
+                                    models.FieldCondition(
+                                        key=source_key, match=models.MatchAny(any=moved)
+                                    )
+                                ]
+                            ),
+                        )
+                    )
+        return stale
+
+    def _retrieve(
+        self, documents: List[Document], ids: List[str]
+    ) -> List[models.Record]:
+        existing: List[models.Record] = []
+        for shard, shard_ids in self._group_by_shard(documents, ids).items():
+            existing.extend(
+                self.client.retrieve(
+                    collection_name=shard.collection_name,
+                    ids=shard_ids,
+                    with_payload=True,
+                    shard_key_selector=shard.shard_key,
+                )
+            )
+        return existing
+
+    async def _aretrieve(
+        self, documents: List[Document], ids: List[str]
+    ) -> List[models.Record]:
+        results = await asyncio.gather(
+            *[
+                self.async_client.retrieve(  # type: ignore
+                    collection_name=shard.collection_name,
+                    ids=shard_ids,
+                    with_payload=True,
+                    shard_key_selector=shard.shard_key,
+                )
+                for shard, shard_ids in self._group_by_shard(documents, ids).items()
+            ]
+        )
+        return [record for records in results for record in records]
+
+    def upsert_sources(self, documents: List[Document]) -> int:
+        """
+        Idempotent ingestion of complete sources: only the changed chunks are written,
+        then the chunks that no longer exist are deleted.
+        Returns the number of points written.
+        """
+        ids = self.point_ids(documents)
+        existing = self._retrieve(documents, ids)
+        changed_docs, changed_ids = self._changed_documents(documents, ids, existing)
+        if changed_docs:
+            self.upsert_documents(changed_docs, changed_ids)
+        for shards, filter in self._stale_chunks_filters(documents, ids):
+            # the chunks of a moved source were just written to the new shard with the same ids
+            self.delete_by_filter(filter, shards, keep_texts=ids)
+        return len(changed_docs)
+
+    async def aupsert_sources(self, documents: List[Document]) -> int:
+        if self.async_client is None:
+            return await self._run_sync(self.upsert_sources, documents)
+        ids = self.point_ids(documents)
+        existing = await self._aretrieve(documents, ids)
+        changed_docs, changed_ids = self._changed_documents(documents, ids, existing)
+        if changed_docs:
+            await self.aupsert_documents(changed_docs, changed_ids)
+        for shards, filter in self._stale_chunks_filters(documents, ids):
+            # the chunks of a moved source were just written to the new shard with the same ids
+            await self.adelete_by_filter(filter, shards, keep_texts=ids)
+        return len(changed_docs)
+
+    def collection_names(self) -> List[str]:
+        return list(dict.fromkeys([_.collection_name for _ in self.shards()]))
+
+    @contextmanager
+    def deferred_indexing(self) -> Iterator[None]:
+        """
+        Turn off HNSW indexing for the duration of a bulk load and turn it back on at the end,
+        so that Qdrant builds the index once instead of on every write.
+        """
+        indexing_thresholds = {}
+        for name in self.collection_names():
+            optimizer = self.client.get_collection(name).config.optimizer_config
+            indexing_thresholds[name] = (
+                optimizer.indexing_threshold or DEFAULT_INDEXING_THRESHOLD
+            )
+            logger.info(f"turn off indexing of {name}")
+            self.client.update_collection(
+                collection_name=name,
+                optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
+            )
+        try:
+            yield
+        finally:
+            for name, indexing_threshold in indexing_thresholds.items():
+                logger.info(
+                    f"turn on indexing of {name}, indexing_threshold={indexing_threshold}"
+                )
+                self.client.update_collection(
+                    collection_name=name,
+                    optimizers_config=models.OptimizersConfigDiff(
+                        indexing_threshold=indexing_threshold
+                    ),
+                )
+
+    def bulk_upload(self, documents: List[Document]) -> None:
+        """
+        Embed and upload the documents with parallel batches, without waiting for each write.
+        Unlike upsert_sources it does not diff against the stored chunks, it is meant for initial loads.
+        """
+        vectors = self.embeddings.embed_documents([_.page_content for _ in documents])  # type: ignore
+        points = self._build_points(documents, vectors, self.point_ids(documents))
+        self._store_texts(documents, points)
+        injest = self.settings.injest
+        for shard, shard_points in self._group_by_shard(documents, points).items():
+            self.client.upload_points(
+                collection_name=shard.collection_name,
+                points=shard_points,
+                batch_size=injest.bulk_batch_size,
+                # QdrantLocal cannot be shared with upload processes
+                parallel=1 if self.async_client is None else injest.bulk_parallel,
+                wait=False,
+                shard_key_selector=shard.shard_key,
+            )
+
+    def wait_indexed(self, timeout: float) -> None:
+        """Log the indexing progress until the collections are green or the timeout is reached"""
+        deadline = time.time() + timeout
+        pending = self.collection_names()
+        while True:
+            for name in list(pending):
+                info = self.client.get_collection(name)
+                logger.info(
+                    f"{name}: status={info.status}, points={info.points_count}, indexed vectors={info.indexed_vectors_count}"
+                )
+                if info.status == models.CollectionStatus.GREEN:
+                    pending.remove(name)
+            if not pending or time.time() > deadline:
+                return
+            time.sleep(5)
@@ -1,10 +1,13 @@
+import asyncio
 import logging
 
 from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from bao.api.chat_router import chat_router, favicon_router
+from bao.api.health_router import health_router
 from bao.api.injest_router import ingest_router
+from bao.components.vectordb import QdrantVectorDB
 from bao.di import global_injector
 from bao.settings.settings import Settings
 from bao.web_client.ingest_ui import IngestUI
@@ -22,8 +25,27 @@ def create_fastapi_app() -> FastAPI:
     app.include_router(favicon_router)
     app.include_router(chat_router)
     app.include_router(ingest_router)
+    app.include_router(health_router)
 
     settings = global_injector.get(Settings)
+
+    async def run_warmup(embeddings) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                embeddings.executor, embeddings.warmup
+            )
+        except Exception:
+            logger.exception(
+                "embedding warm-up failed, the model is loaded by the first request instead"
+            )
+            embeddings.mark_ready()
+
+    @app.on_event("startup")
+    async def warmup_embeddings() -> None:
+        if settings.embedding.warmup_on_startup:
+            embeddings = global_injector.get(QdrantVectorDB).embeddings
+            # in the background: the liveness probe must answer while the model loads
+            app.state.warmup_task = asyncio.create_task(run_warmup(embeddings))
     if settings.server.cors.enabled:
         logger.debug("CORS settings")
         app.add_middleware(
@@ -1,8 +1,13 @@
-from typing import Dict, List, Literal, Union
+from typing import Any, Dict, List, Literal, Union
 
 from pydantic import BaseModel, Field, field_validator
 
-from bao.components import METADATA_TYPE, MODEL_TYPES
+from bao.components import (
+    EMBEDDING_BACKEND,
+    GRADER_MODEL_TYPES,
+    METADATA_TYPE,
+    MODEL_TYPES,
+)
 from bao.settings.settings_loader import load_active_settings
 from bao.utils.strings import date_from_yyyy, date_from_yyyymm, date_from_yyyymmdd
 
@@ -48,6 +53,23 @@ class LocalSettings(BaseModel):
     embedding_hf_model_tokens: int | None = Field(
         512, description="Max number of tokens the HuggingFace embedding model can take"
     )
+    embedding_backend: EMBEDDING_BACKEND = Field(
+        "torch-fp32",
+        description=(
+            "Runtime for the embedding model on CPU.\n"
+            "If `torch-fp32` - the PyTorch model as downloaded from HuggingFace.\n"
+            "If `torch-dynamic-int8` - linear layers dynamically quantized to int8.\n"
+            "If `onnxruntime` - the model exported to ONNX and run by onnxruntime.\n"
+            "Convert the model once with `python -m bao.utils.embedding_export --check`."
+        ),
+    )
+    reranker_hf_model_name: str | None = Field(
+        "BAAI/bge-reranker-base",
+        description="Name of the HuggingFace cross-encoder used by the `cross-encoder` grader",
+    )
+    reranker_hf_model_tokens: int = Field(
+        512, description="Max number of tokens of a (question, document) pair for the reranker"
+    )
     prompt_style: Literal["default", "llama2", "tag", "mistral", "chatml"] = Field(
         "llama2",
         description=(
@@ -70,14 +92,73 @@ class EmbeddingSettings(BaseModel):
     count_workers: int = Field(
         2,
         description=(
-            "The number of workers to use for file ingestion.\n"
-            "In `batch` mode, this is the number of workers used to parse the files.\n"
-            "In `parallel` mode, this is the number of workers used to parse the files and embed them.\n"
-            "This is only used if `ingest_mode` is not `simple`.\n"
-            "Do not go too high with this number, as it might cause memory issues. (especially in `parallel` mode)\n"
+            "The number of worker processes used to embed documents in bulk on folder ingestion.\n"
+            "They are stopped when the ingestion is done, the API server embeds in-process.\n"
+            "Each worker loads its own copy of the embedding model. Set it to 1 to embed in-process.\n"
+            "Do not go too high with this number, as it might cause memory issues.\n"
             "Do not set it higher than your number of threads of your CPU."
         ),
     )
+    worker_threads: int | None = Field(
+        None,
+        description="torch threads of each embedding worker. Defaults to the number of CPUs divided by count_workers",
+    )
+    bucket_max_tokens: int = Field(
+        16384,
+        description="Max number of tokens (after padding) of one length bucket when embedding documents in bulk",
+    )
+    batch_max_size: int = Field(
+        32,
+        description="Max number of texts merged into one model forward pass by the embedding batcher",
+    )
+    batch_max_wait_ms: float = Field(
+        5,
+        description=(
+            "How long (in milliseconds) the embedding batcher waits for concurrent requests before running a batch.\n"
+            "Set it to 0 to disable batching and run every request on its own."
+        ),
+    )
+    store_enabled: bool = Field(
+        False,
+        description="Keep document embeddings in a persistent store so that re-ingested chunks are not embedded again",
+    )
+    store_path: str | None = Field(
+        None,
+        description="Folder of the document embedding store. Defaults to data/models/embedding_store",
+    )
+    store_max_entries: int = Field(
+        100000,
+        description=(
+            "Max number of vectors in the document embedding store. "
+            "The least recently used vectors are evicted when it is full.\n"
+            "The store file takes max_entries * embedding_size * 4 bytes of disk."
+        ),
+    )
+    warmup_on_startup: bool = Field(
+        True,
+        description=(
+            "Load and warm up the embedding model in the background when the server starts.\n"
+            "/health/ready reports ready only once this is done."
+        ),
+    )
+    async_workers: int = Field(
+        4,
+        description="Size of the thread pool that runs embedding for async callers (aembed_query, aembed_documents)",
+    )
+    query_cache_max_bytes: int = Field(
+        64 * 1024 * 1024,
+        description="Memory bound (in bytes) of the in-process query vector cache",
+    )
+    query_cache_ttl: int | None = Field(
+        86400, description="expire time in seconds of a cached query vector"
+    )
+    query_cache_shared: bool = Field(
+        True,
+        description="Share query vectors between processes through an on-disk tier next to the document embedding store",
+    )
+    query_cache_shared_max_entries: int = Field(
+        50000, description="Max number of vectors in the shared query vector tier"
+    )
 
 
 class AnthropicSettings(BaseModel):
@@ -116,6 +197,76 @@ class GoogleSettings(BaseModel):
     model: str = Field("gemini-pro", description="model name")
 
 
+class QdrantCollectionSettings(BaseModel):
+    payload_indexes: bool = Field(
+        True,
+        description="Create payload indexes for the fields declared in retriever.metadata: `str` as keyword and `int` as integer. "
+        "Skipped with the local Qdrant (path or :memory:), where they have no effect",
+    )
+    hnsw_m: int | None = Field(
+        None,
+        description="Number of edges per node in the HNSW graph. Qdrant default when not set.",
+    )
+    hnsw_ef_construct: int | None = Field(
+        None,
+        description="Number of neighbours considered while building the HNSW index. Qdrant default when not set.",
+    )
+    on_disk_vectors: bool | None = Field(
+        None, description="If `true` - serve the original vectors from disk"
+    )
+    on_disk_payload: bool | None = Field(
+        None,
+        description="If `true` - keep payloads on disk. Indexed payload fields stay in RAM.",
+    )
+    scalar_quantization: bool = Field(
+        False, description="If `true` - keep an int8 scalar quantized copy of vectors"
+    )
+    quantization_quantile: float | None = Field(
+        0.99, description="Quantile used to compute the int8 quantization range"
+    )
+    quantization_always_ram: bool | None = Field(
+        True, description="If `true` - quantized vectors are always kept in RAM"
+    )
+    reconcile: bool = Field(
+        False,
+        description=(
+            "Update the config of an existing collection when it differs from these settings. "
+            "Off by default: it may move the payloads or vectors between RAM and disk on startup"
+        ),
+    )
+    external_text: bool = Field(
+        False,
+        description=(
+            "If `true` - keep chunk texts in a local compressed store (sqlite + zstd, zlib without zstandard) "
+            "keyed by point id, and only the filterable metadata in the Qdrant payload.\n"
+            "Texts are fetched in one batched lookup after ranking. Re-ingest the collection after changing it."
+        ),
+    )
+    text_store_path: str = Field(
+        "data/chunk_text", description="Folder of the external chunk text store"
+    )
+
+
+class QdrantReplicaSettings(BaseModel):
+    enabled: bool = Field(
+        False,
+        description=(
+            "Keep an in-process copy of the collection and search it instead of the Qdrant server while it is fresh. "
+            "Meant for small deployments where the whole collection fits in RAM."
+        ),
+    )
+    dtype: Literal["float32", "int8"] = Field(
+        "float32", description="Storage type of the replica vectors"
+    )
+    max_points: int = Field(
+        200000, description="The replica is not loaded when the collection is larger"
+    )
+    full_reload_after: int = Field(
+        1000,
+        description="Reload the whole replica instead of the changed sources when more log records are pending",
+    )
+
+
 class QdrantSettings(BaseModel):
     location: str | None = Field(
         None,
@@ -168,6 +319,18 @@ class QdrantSettings(BaseModel):
             "Only use this if you can guarantee that you can resolve the thread safety outside QdrantClient."
         ),
     )
+    collection: QdrantCollectionSettings = Field(
+        default_factory=QdrantCollectionSettings,  # type: ignore
+        description="Index and storage tuning of the collection",
+    )
+    replica: QdrantReplicaSettings = Field(
+        default_factory=QdrantReplicaSettings,  # type: ignore
+        description="In-process replica of the collection",
+    )
+
+    def client_params(self) -> Dict[str, Any]:
+        """Params of QdrantClient, without the collection tuning"""
+        return self.model_dump(exclude_unset=True, exclude={"collection", "replica"})
 
 
 class IngestUISettings(BaseModel):
@@ -302,10 +465,161 @@ class RetrieverSettings(BaseModel):
     score_threshold: float = Field(0.7, description="Threshold for retriever top-k")
     metadata: MetadataSchema
     collection_name: str = Field(description="collection name of vector db")
+    sharding: Literal["none", "collection", "shard_key"] = Field(
+        "none",
+        description=(
+            "Split the documents by topic. `collection` - one collection per topic, named {collection_name}_{topic}. "
+            "`shard_key` - one collection with a custom shard key per topic, needs a Qdrant server. "
+            "Re-ingest the documents after changing it."
+        ),
+    )
+    shard_topics: List[str] | None = Field(
+        None,
+        description="Topics with their own shard. Defaults to the document topics of TOPIC_TYPE",
+    )
+    result_cache_max_entries: int = Field(
+        10000,
+        description="Max number of cached search results, keyed by query, filter, k and score threshold. 0 to disable",
+    )
+    result_cache_ttl: int | None = Field(
+        3600,
+        description="Seconds a cached search result lives. Ingestion invalidates the cache anyway",
+    )
+    speculative_search: bool = Field(
+        True,
+        description="Search with the raw question while the intent classification and the query rewrite are running",
+    )
+    speculative_scale: int = Field(
+        3,
+        description="The speculative search fetches k times it, so that the filters of the rewritten query can be applied afterwards",
+    )
+    speculative_min_similarity: float = Field(
+        0.95,
+        description="Min cosine similarity between the raw question and the rewritten query to reuse the speculative search",
+    )
 
 
 class GraderSettings(BaseModel):
     k: int | None = Field(4, description="number of keepings")
+    auto_accept_score: float | None = Field(
+        None,
+        description="Documents with a vector score at or above it are kept without the LLM grader",
+    )
+    auto_reject_score: float | None = Field(
+        None,
+        description="Documents with a vector score below it are dropped without the LLM grader. "
+        "Under retriever.score_threshold it only applies to the fallback documents the retriever keeps when none passes",
+    )
+    early_exit: bool = Field(
+        True,
+        description="Return as soon as the k best scored relevant documents are confirmed and cancel the other grader calls",
+    )
+    rerank_threshold: float = Field(
+        0.5, description="Min relevance (0 to 1) of the cross-encoder to keep a document"
+    )
+    rerank_batch_size: int = Field(
+        16, description="Number of (question, document) pairs per cross-encoder forward pass"
+    )
+    mode: Literal["pointwise", "listwise"] = Field(
+        "pointwise",
+        description=(
+            "If `pointwise` - one LLM call per document.\n"
+            "If `listwise` - all the documents of a question graded in one LLM call, "
+            "split into several calls only when over listwise_max_tokens. "
+            "Documents missing from a malformed answer are graded pointwise."
+        ),
+    )
+    listwise_max_tokens: int = Field(
+        6000, description="Estimated prompt token budget of a listwise grader call"
+    )
+    listwise_doc_max_tokens: int = Field(
+        800, description="Documents are truncated to it in the listwise prompt"
+    )
+    verdict_cache_path: str | None = Field(
+        "data/grader_cache",
+        description="Folder of the persistent cache of LLM grader verdicts per (question, chunk). None to disable",
+    )
+    verdict_cache_ttl: int | None = Field(
+        604800, description="Seconds a cached grader verdict lives"
+    )
+
+
+class IntentSettings(BaseModel):
+    enabled: bool = Field(
+        False,
+        description=(
+            "Classify the intent locally with the query vector: nearest greeting exemplar and topic centroids "
+            "of the collection. The LLM classifier is only called when uncertain. "
+            "The similarity thresholds depend on the embedding model, calibrate them before enabling"
+        ),
+    )
+    greeting_exemplars: List[str] = Field(
+        ["hi", "hello", "hey", "good morning", "thanks", "thank you", "你好", "谢谢"],
+        description="Greeting-like questions, compared to the question one by one",
+    )
+    greeting_replies: List[str] = Field(
+        [],
+        description="Canned replies to greetings, served without LLM. The greeting LLM chain answers when empty",
+    )
+    greeting_min_similarity: float = Field(
+        0.9,
+        description="Min cosine similarity to a greeting exemplar to classify as greeting locally",
+    )
+    topic_min_similarity: float = Field(
+        0.8,
+        description="Min cosine similarity to a topic centroid to classify as the topic locally",
+    )
+    min_margin: float = Field(
+        0.05,
+        description="Min similarity gap between the best and the second best intents to decide locally",
+    )
+    max_topic_points: int = Field(
+        2000, description="Max points of a topic averaged into its centroid"
+    )
+    refresh_interval: float = Field(
+        3600,
+        description="Min seconds between two rebuilds of the topic centroids after ingestion",
+    )
+
+
+class SearchModeSettings(BaseModel):
+    query_rewrite: bool = Field(
+        False,
+        description="Rewrite the search query by LLM. The filters are parsed locally from the question otherwise",
+    )
+    intent_classification: bool = Field(
+        False,
+        description="Classify the topic by LLM. The topic is found by topic_keywords otherwise",
+    )
+    grader: bool = Field(
+        False,
+        description="Grade the search results by the grader chain. They are ranked by vector score otherwise",
+    )
+    topic_keywords: Dict[str, List[str]] = Field(
+        {},
+        description="topic -> keywords. A search question containing a keyword is filtered by the topic",
+    )
+
+
+class AnswerCacheSettings(BaseModel):
+    enabled: bool = Field(
+        False,
+        description="Serve the answer of a semantically identical question asked before, with the same filter",
+    )
+    min_similarity: float = Field(
+        0.97,
+        description="Min cosine similarity between the rewritten queries to serve the cached answer. "
+        "It depends on the embedding model, calibrate it on pairs of different questions before enabling",
+    )
+    history_min_similarity: float = Field(
+        0.9,
+        description=(
+            "With a chat history, the answer is only cached and served when the rewritten query is this similar "
+            "to the question, i.e. the question does not depend on the history"
+        ),
+    )
+    max_entries: int = Field(1000, description="Max number of cached answers")
+    ttl: int | None = Field(86400, description="Seconds a cached answer lives")
 
 
 class ChainTemplates(BaseModel):
@@ -325,10 +639,14 @@ class ChainTemplates(BaseModel):
     query_rewrite_template: str = Field(
         description="prompt template for query rewrite for retriever"
     )
-    grader_model: MODEL_TYPES = Field(description="grader models")
+    grader_model: GRADER_MODEL_TYPES = Field(description="grader models. `cross-encoder` - the local reranker of local.reranker_hf_model_name")  # type: ignore
     grader_template: str = Field(
         description="grader template for question <-> document. return {'score': 'yes' or 'no'}"
     )
+    grader_listwise_template: str | None = Field(
+        None,
+        description="grader template for question <-> numbered documents in listwise mode. Defaults to a built-in one",
+    )
 
 
 class InjestSettings(BaseModel):
@@ -336,6 +654,21 @@ class InjestSettings(BaseModel):
     chunk_overlap: int = Field(description="chunk overlap size.")
     injest_from: str = Field(description="source folder for data injestion")
     default_topic: str = Field(description="default topic when none valid topic given")
+    bulk_batch_size: int = Field(
+        256, description="Number of points per upload request in bulk mode"
+    )
+    bulk_parallel: int = Field(
+        2, description="Number of parallel upload processes in bulk mode"
+    )
+    bulk_index_timeout: int = Field(
+        600,
+        description="Max seconds to wait and report the indexing progress after a bulk load",
+    )
+    log_check_interval: float = Field(
+        1.0,
+        description="Seconds between two lookups of the head of the injest event log, "
+        "shared by the replica and the caches to tell if the collection changed",
+    )
 
 
 class CorsSettings(BaseModel):
@@ -418,6 +751,18 @@ class Settings(BaseModel):
     web_ingest: IngestUISettings
     retriever: RetrieverSettings
     grader: GraderSettings
+    intent: IntentSettings = Field(
+        default_factory=IntentSettings,  # type: ignore
+        description="Local intent classification",
+    )
+    search_mode: SearchModeSettings = Field(
+        default_factory=SearchModeSettings,  # type: ignore
+        description="Pipeline of the search mode, questions starting with `/s`",
+    )
+    answer_cache: AnswerCacheSettings = Field(
+        default_factory=AnswerCacheSettings,  # type: ignore
+        description="Semantic cache of the chat answers",
+    )
     chain_templates: ChainTemplates
     injest: InjestSettings
     server: ServerSettings
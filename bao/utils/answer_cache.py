@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    In-process semantic cache of the chat answers.
+    An entry is found by the cosine similarity of the query vectors, among the entries of the same filter.
+    Entries remember the sources cited by the answer, to be dropped when one of them changes.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # id of the last injest log record applied to the cache
+        self.log_id: Optional[int] = None
+        self._next_id = 0
+        # entry id -> (filter key, normalized vector, answer, cited sources, expire at)
+        self._entries: Dict[
+            int, Tuple[str, np.ndarray, Dict[str, Any], Set[str], float]
+        ] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def filter_key(filter: Optional[Dict[str, Any]], k: int) -> str:
+        return json.dumps(
+            [filter or {}, k], sort_keys=True, ensure_ascii=False, default=str
+        )
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(
+        self, vector: Sequence[float], filter_key: str, min_similarity: float
+    ) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """The most similar answer of the filter above min_similarity, with its similarity"""
+        vector = self._normalize(vector)
+        now = time.time()
+        with self.lock:
+            expired = [i for i, _ in self._entries.items() if _[4] < now]
+            for i in expired:
+                del self._entries[i]
+            candidates = [
+                (i, _) for i, _ in self._entries.items() if _[0] == filter_key
+            ]
+            best = None
+            if candidates:
+                similarities = np.stack([entry[1] for _, entry in candidates]) @ vector
+                top = int(np.argmax(similarities))
+                if similarities[top] >= min_similarity:
+                    best = (float(similarities[top]), candidates[top][1][2])
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def put(
+        self,
+        vector: Sequence[float],
+        filter_key: str,
+        answer: Dict[str, Any],
+        sources: Iterable[str],
+        log_id: Optional[int],
+    ) -> None:
+        """Cache the answer computed at the injest log id `log_id`, unless the log moved on since"""
+        expire_at = time.time() + self.ttl if self.ttl else float("inf")
+        with self.lock:
+            if log_id != self.log_id:
+                return
+            self._entries[self._next_id] = (
+                filter_key,
+                self._normalize(vector),
+                answer,
+                set(sources),
+                expire_at,
+            )
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                # dicts keep the insertion order, drop the oldest
+                del self._entries[next(iter(self._entries))]
+
+    def sync(self, records: List[Tuple[int, str, str, str]], source_key: str) -> None:
+        """
+        Apply the injest log records (id, op, meta_key, meta_value):
+        drop the answers citing an upserted or removed source, all of them on other keys.
+        """
+        if not records:
+            return
+        with self.lock:
+            sources = set([_[3] for _ in records if _[2] == source_key])
+            if any([_[2] != source_key for _ in records]):
+                stale = list(self._entries)
+            else:
+                stale = [i for i, _ in self._entries.items() if _[3] & sources]
+            for i in stale:
+                del self._entries[i]
+            self.invalidations += len(stale)
+            self.log_id = records[-1][0]
+
+    def stats(self) -> Dict[str, int | float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,103 @@
+import logging
+import sqlite3
+import threading
+import zlib
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+SQLITE_MAX_VARS = 500
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+    logger.info("zstandard is not installed, chunk texts are compressed with zlib")
+
+# first byte of a stored body tells the codec
+ZSTD, ZLIB = b"z", b"d"
+
+# zstandard (de)compressors are not thread-safe, one pair per thread
+_zstd = threading.local()
+
+
+def _zstd_compressor() -> "zstandard.ZstdCompressor":
+    if not hasattr(_zstd, "compressor"):
+        _zstd.compressor = zstandard.ZstdCompressor(level=9)
+    return _zstd.compressor
+
+
+def _zstd_decompressor() -> "zstandard.ZstdDecompressor":
+    if not hasattr(_zstd, "decompressor"):
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.decompressor
+
+
+def compress(text: str) -> bytes:
+    if zstandard is not None:
+        return ZSTD + _zstd_compressor().compress(text.encode())
+    return ZLIB + zlib.compress(text.encode(), 9)
+
+
+def decompress(body: bytes) -> str:
+    codec, data = body[:1], body[1:]
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ImportError(
+                "chunk text is compressed with zstd. try 'pip install -U zstandard'"
+            )
+        return _zstd_decompressor().decompress(data).decode()
+    return zlib.decompress(data).decode()
+
+
+class ChunkTextStore:
+    """
+    Local compressed key-value store of chunk texts, keyed by vector db point id.
+    Lets the vector db keep only the filterable metadata in its payloads.
+    """
+
+    def __init__(self, db_root: str, collection_name: str) -> None:
+        Path(db_root).mkdir(parents=True, exist_ok=True)
+        self.db_file = Path(db_root) / f"{collection_name}.sqlite"
+        with closing(self._connect()) as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (
+                point_id TEXT PRIMARY KEY,
+                body BLOB
+            )"""
+            )
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def put_many(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """entries: (point id, text)"""
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (point_id, body) VALUES (?, ?)",
+                [(str(point_id), compress(text)) for point_id, text in entries],
+            )
+            conn.commit()
+
+    def get_many(self, point_ids: Iterable[str]) -> Dict[str, str]:
+        point_ids = list(set([str(_) for _ in point_ids]))
+        texts: Dict[str, str] = {}
+        with closing(self._connect()) as conn:
+            for i in range(0, len(point_ids), SQLITE_MAX_VARS):
+                chunk = point_ids[i : i + SQLITE_MAX_VARS]
+                query = f"SELECT point_id, body FROM chunks WHERE point_id in ({','.join(['?'] * len(chunk))})"
+                for point_id, body in conn.execute(query, chunk).fetchall():
+                    texts[point_id] = decompress(body)
+        return texts
+
+    def remove(self, point_ids: List[str]) -> None:
+        point_ids = [str(_) for _ in point_ids]
+        with closing(self._connect()) as conn:
+            for i in range(0, len(point_ids), SQLITE_MAX_VARS):
+                chunk = point_ids[i : i + SQLITE_MAX_VARS]
+                query = f"DELETE FROM chunks WHERE point_id in ({','.join(['?'] * len(chunk))})"
+                conn.execute(query, chunk)
+            conn.commit()
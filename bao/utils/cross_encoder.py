@@ -0,0 +1,53 @@
+import logging
+from typing import List
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from transformers.utils import is_accelerate_available
+
+from bao import MODEL_CACHE
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoderReranker:
+    """
+    Local cross-encoder scoring (question, document) pairs on CPU.
+    Scores are relevance probabilities in [0, 1].
+    """
+
+    def __init__(self, model_id: str, max_tokens: int, batch_size: int) -> None:
+        logger.info(f"Loading cross-encoder {model_id}")
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE)  # type: ignore
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            model_id,
+            cache_dir=MODEL_CACHE,
+            low_cpu_mem_usage=is_accelerate_available(),
+        )  # type: ignore
+        self.model.eval()
+
+    def _relevance(self, logits: torch.Tensor) -> torch.Tensor:
+        if logits.shape[-1] == 1:
+            return torch.sigmoid(logits[:, 0])
+        # [irrelevant, relevant] classifier heads
+        return torch.softmax(logits, dim=-1)[:, 1]
+
+    def score(self, question: str, documents: List[str]) -> List[float]:
+        scores: List[float] = []
+        for i in range(0, len(documents), self.batch_size):
+            batch = documents[i : i + self.batch_size]
+            batch_dict = self.tokenizer(
+                [question] * len(batch),
+                batch,
+                max_length=self.max_tokens,
+                padding=True,
+                truncation="only_second",
+                return_tensors="pt",
+            )
+            with torch.inference_mode():
+                logits = self.model(**batch_dict).logits
+            scores.extend(self._relevance(logits).tolist())
+        return scores
@@ -0,0 +1,259 @@
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import AutoModel, AutoTokenizer
+from transformers.utils import is_accelerate_available
+
+from bao import MODEL_CACHE
+from bao.components import EMBEDDING_BACKEND
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL_FILE = "model.onnx"
+INT8_MODEL_FILE = "model.int8.pt"
+
+# model copy of an embedding worker process, see init_worker
+_worker_backend: Optional["EmbeddingBackend"] = None
+
+
+def average_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
+    last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
+    return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
+
+
+def optimized_model_dir(model_id: str, backend: EMBEDDING_BACKEND) -> Path:
+    """Folder under MODEL_CACHE where the converted model of `backend` is stored"""
+    return MODEL_CACHE / "optimized" / model_id.replace("/", "--") / backend
+
+
+class EmbeddingBackend:
+    """
+    Tokenize, run the encoder, mean-pool and L2 normalize.
+    Subclasses only provide the encoder forward pass.
+    """
+
+    name: EMBEDDING_BACKEND
+
+    def __init__(self, model_id: str, max_tokens: int) -> None:
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE)  # type: ignore
+
+    def tokenize(self, texts: List[str], return_tensors: str = "pt") -> Dict[str, Any]:
+        return self.tokenizer(
+            texts,
+            max_length=self.max_tokens,
+            padding=True,
+            truncation=True,
+            return_tensors=return_tensors,
+        )
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        return token_lengths(self.tokenizer, texts, self.max_tokens)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+def load_tokenizer(model_id: str) -> Any:
+    return AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE)  # type: ignore
+
+
+def token_lengths(tokenizer: Any, texts: List[str], max_tokens: int) -> List[int]:
+    input_ids = tokenizer(texts, max_length=max_tokens, truncation=True)["input_ids"]
+    return [len(_) for _ in input_ids]
+
+
+class TorchBackend(EmbeddingBackend):
+    name: EMBEDDING_BACKEND = "torch-fp32"
+
+    def __init__(self, model_id: str, max_tokens: int) -> None:
+        super().__init__(model_id, max_tokens)
+        self.model = self.load_model()
+        self.model.eval()
+
+    def load_model(self) -> torch.nn.Module:
+        # safetensors checkpoints are memory-mapped by transformers,
+        # with accelerate the weights are also not materialized twice
+        return AutoModel.from_pretrained(
+            self.model_id,
+            cache_dir=MODEL_CACHE,
+            low_cpu_mem_usage=is_accelerate_available(),
+        )  # type: ignore
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        batch_dict = self.tokenize(texts)
+        with torch.inference_mode():
+            outputs = self.model(**batch_dict)
+            embeddings = average_pool(
+                outputs.last_hidden_state, batch_dict["attention_mask"]  # type: ignore
+            )
+            embeddings = F.normalize(embeddings, p=2, dim=1)
+        return embeddings.cpu().numpy()
+
+
+class TorchInt8Backend(TorchBackend):
+    """
+    Linear layers dynamically quantized to int8.
+    Uses the converted model in MODEL_CACHE when present, otherwise quantizes on load.
+    """
+
+    name: EMBEDDING_BACKEND = "torch-dynamic-int8"
+
+    def load_model(self) -> torch.nn.Module:
+        model_file = optimized_model_dir(self.model_id, self.name) / INT8_MODEL_FILE
+        if model_file.exists():
+            return torch.load(model_file)
+        logger.warning(
+            f"{model_file} not found, quantizing {self.model_id} on load. "
+            "Run `python -m bao.utils.embedding_export` to convert it once."
+        )
+        return quantize_dynamic_int8(super().load_model())
+
+
+class OnnxBackend(EmbeddingBackend):
+    name: EMBEDDING_BACKEND = "onnxruntime"
+
+    def __init__(self, model_id: str, max_tokens: int) -> None:
+        super().__init__(model_id, max_tokens)
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "cannot import onnxruntime. try 'pip install -U onnxruntime'"
+            )
+        model_file = optimized_model_dir(model_id, self.name) / ONNX_MODEL_FILE
+        if not model_file.exists():
+            raise ValueError(
+                f"{model_file} not found. Run `python -m bao.utils.embedding_export --backend onnxruntime` first."
+            )
+        self.session = ort.InferenceSession(
+            str(model_file), providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [_.name for _ in self.session.get_inputs()]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        batch_dict = self.tokenize(texts, return_tensors="np")
+        feeds = {
+            name: batch_dict[name].astype(np.int64)
+            for name in self.input_names
+            if name in batch_dict
+        }
+        last_hidden = self.session.run(["last_hidden_state"], feeds)[0]
+        mask = batch_dict["attention_mask"][..., None].astype(last_hidden.dtype)
+        embeddings = (last_hidden * mask).sum(axis=1) / mask.sum(axis=1)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    TorchInt8Backend.name: TorchInt8Backend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+
+def load_backend(
+    backend: EMBEDDING_BACKEND, model_id: str, max_tokens: int
+) -> EmbeddingBackend:
+    if backend not in BACKENDS:
+        raise ValueError(f"Not support embedding backend: {backend}")
+    logger.info(f"Loading embedding model {model_id} with backend: {backend}")
+    return BACKENDS[backend](model_id, max_tokens)
+
+
+def quantize_dynamic_int8(model: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def export_model(backend: EMBEDDING_BACKEND, model_id: str) -> Path:
+    """
+    Convert the HF model for the given backend and save it into MODEL_CACHE.
+    Returns the path of the converted model.
+    """
+    output_dir = optimized_model_dir(model_id, backend)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model = AutoModel.from_pretrained(model_id, cache_dir=MODEL_CACHE)  # type: ignore
+    model.eval()
+    if backend == "torch-dynamic-int8":
+        output = output_dir / INT8_MODEL_FILE
+        torch.save(quantize_dynamic_int8(model), output)
+    elif backend == "onnxruntime":
+        output = output_dir / ONNX_MODEL_FILE
+        tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE)  # type: ignore
+        sample = tokenizer(["query: hello", "passage: hi"], return_tensors="pt")
+        dynamic_axes = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                (sample["input_ids"], sample["attention_mask"]),
+                str(output),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": dynamic_axes,
+                    "attention_mask": dynamic_axes,
+                    "last_hidden_state": dynamic_axes,
+                },
+                opset_version=14,
+            )
+    else:
+        raise ValueError(f"{backend} does not need to be converted.")
+    logger.info(f"{model_id} converted for {backend}: {output}")
+    return output
+
+
+def parity_check(
+    backend: EMBEDDING_BACKEND, model_id: str, max_tokens: int, texts: List[str]
+) -> float:
+    """
+    Embed `texts` with torch-fp32 and with `backend`.
+    Returns the min cosine similarity between the two outputs.
+    """
+    reference = TorchBackend(model_id, max_tokens).encode(texts)
+    candidate = load_backend(backend, model_id, max_tokens).encode(texts)
+    cosine = (reference * candidate).sum(axis=1)
+    return float(cosine.min())
+
+
+def length_buckets(
+    lengths: List[int], max_size: int, max_tokens: int
+) -> List[List[int]]:
+    """
+    Group text indices of similar token length together.
+    A bucket holds at most `max_size` texts and `max_tokens` tokens after padding.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets: List[List[int]] = []
+    bucket: List[int] = []
+    for i in order:
+        # sorted ascending, so the current text sets the padded length
+        if bucket and (
+            len(bucket) >= max_size or lengths[i] * (len(bucket) + 1) > max_tokens
+        ):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def init_worker(
+    backend: EMBEDDING_BACKEND, model_id: str, max_tokens: int, num_threads: int
+) -> None:
+    """Initializer of the embedding worker processes, loads one model copy per process"""
+    global _worker_backend
+    torch.set_num_threads(num_threads)
+    _worker_backend = load_backend(backend, model_id, max_tokens)
+
+
+def encode_in_worker(texts: List[str]) -> np.ndarray:
+    return _worker_backend.encode(texts)  # type: ignore
@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Collect concurrent embedding requests for a short time window and run them
+    through the model as one padded batch, then fan the vectors back to the callers.
+    """
+
+    def __init__(
+        self,
+        inference: Callable[[List[str]], Sequence[Sequence[float]]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+    ) -> None:
+        self.inference = inference
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future
+
+    def embed(self, texts: List[str]) -> Sequence[Sequence[float]]:
+        """Block until the batch containing `texts` has been embedded."""
+        return self.submit(texts).result()
+
+    def _collect(self) -> List[Tuple[List[str], Future]]:
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            texts = [t for texts, _ in batch for t in texts]
+            try:
+                vectors = self.inference(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            logger.debug(f"embedded {len(texts)} texts from {len(batch)} requests")
+            offset = 0
+            for texts, future in batch:
+                future.set_result(vectors[offset : offset + len(texts)])
+                offset += len(texts)
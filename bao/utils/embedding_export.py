@@ -0,0 +1,64 @@
+import argparse
+import logging
+import sys
+from typing import get_args
+
+from bao.components import EMBEDDING_BACKEND
+from bao.settings.settings import settings
+from bao.utils.embedding_backends import export_model, parity_check
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+PARITY_TEXTS = [
+    "query: how does the tokenizer handle unicode?",
+    "query: 直播里讲了什么？",
+    "passage: 00:12:30 byte pair encoding merges the most frequent pair of tokens",
+    "passage: hi every one!",
+]
+
+parser = argparse.ArgumentParser(
+    description="Convert the embedding model into an optimized CPU backend under MODEL_CACHE"
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    choices=[_ for _ in get_args(EMBEDDING_BACKEND) if _ != "torch-fp32"],
+    default=None,
+    help="target backend. Defaults to local.embedding_backend in settings",
+    required=False,
+)
+parser.add_argument(
+    "--check",
+    action="store_true",
+    help="compare the converted model output against torch-fp32",
+    required=False,
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.99,
+    help="min cosine similarity to torch-fp32 accepted by the parity check",
+    required=False,
+)
+
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    local_settings = settings().local
+    backend = args.backend or local_settings.embedding_backend
+    model_id = local_settings.embedding_hf_model_name
+    export_model(backend, model_id)  # type: ignore
+    if args.check:
+        min_cosine = parity_check(
+            backend, model_id, local_settings.embedding_hf_model_tokens, PARITY_TEXTS  # type: ignore
+        )
+        logger.info(f"parity check {backend} vs torch-fp32: min cosine={min_cosine:0.5f}")
+        if min_cosine < args.tolerance:
+            logger.error(f"parity check failed, tolerance: {args.tolerance}")
+            sys.exit(1)
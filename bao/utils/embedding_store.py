@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SQLITE_MAX_VARS = 500
+# seconds the access times of the lookups are kept in memory before written to the index
+ACCESS_FLUSH_INTERVAL = 60
+
+
+class EmbeddingStore:
+    """
+    Disk-backed, memory-mapped embedding store.
+    Vectors live in a fixed size float32 matrix file, one slot per entry.
+    A sqlite index maps the content address (model id + text hash) to its slot.
+    When the store is full, the least recently used slots are reused.
+    Each slot also holds a tag of its key, checked on read: another process may reuse the slot
+    between the index lookup and the read of the vector.
+    """
+
+    def __init__(
+        self, root: str | Path, dim: int, max_entries: int, namespace: str = "passage"
+    ) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.max_entries = max_entries
+        self.index_file = self.root / f"{namespace}.sqlite"
+        self.vectors_file = self.root / f"{namespace}.f32"
+        self.tags_file = self.root / f"{namespace}.tags"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # key -> last access time, not written to the index yet
+        self._pending_access: Dict[str, float] = {}
+        self._flushed_at = time.time()
+        expected_size = max_entries * dim * np.dtype(np.float32).itemsize
+        expected_tags_size = max_entries * np.dtype(np.uint64).itemsize
+        if self.vectors_file.exists() and (
+            self.vectors_file.stat().st_size != expected_size
+            or not self.tags_file.exists()
+            or self.tags_file.stat().st_size != expected_tags_size
+        ):
+            logger.warning(
+                f"{self.vectors_file} does not match dim={dim}, max_entries={max_entries}. Rebuilding the store."
+            )
+            self.vectors_file.unlink()
+            self.tags_file.unlink(missing_ok=True)
+            self.index_file.unlink(missing_ok=True)
+        self.vectors = np.memmap(
+            self.vectors_file,
+            dtype=np.float32,
+            mode="r+" if self.vectors_file.exists() else "w+",
+            shape=(max_entries, dim),
+        )
+        # tag of the key of each slot, 0 while the slot is being written
+        self.tags = np.memmap(
+            self.tags_file,
+            dtype=np.uint64,
+            mode="r+" if self.tags_file.exists() else "w+",
+            shape=(max_entries,),
+        )
+        with closing(self._connect()) as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                slot INTEGER UNIQUE,
+                last_access REAL
+            )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)"
+            )
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_file, timeout=30)
+
+    @staticmethod
+    def key(model_id: str, text: str) -> str:
+        return hashlib.sha256(f"{model_id}\x00{text}".encode()).hexdigest()
+
+    @staticmethod
+    def _tag(key: str) -> np.uint64:
+        return np.uint64(int(key[:16], 16) or 1)
+
+    def _flush_access(self, conn: sqlite3.Connection) -> None:
+        """Write the pending access times, the caller holds the lock and commits"""
+        if self._pending_access:
+            conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(t, key) for key, t in self._pending_access.items()],
+            )
+            self._pending_access = {}
+        self._flushed_at = time.time()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Return the stored vectors of the given keys. Missing keys are left out."""
+        keys = list(set(keys))
+        found: Dict[str, np.ndarray] = {}
+        with self.lock, closing(self._connect()) as conn:
+            for i in range(0, len(keys), SQLITE_MAX_VARS):
+                chunk = keys[i : i + SQLITE_MAX_VARS]
+                query = f"SELECT key, slot FROM embeddings WHERE key in ({','.join(['?'] * len(chunk))})"
+                for key, slot in conn.execute(query, chunk).fetchall():
+                    tag = self._tag(key)
+                    if self.tags[slot] != tag:
+                        continue
+                    vector = np.array(self.vectors[slot])
+                    # the slot was reused by another process while reading
+                    if self.tags[slot] != tag:
+                        continue
+                    found[key] = vector
+            now = time.time()
+            # access times are written in batches, the LRU order is only as precise as the interval
+            self._pending_access.update({_: now for _ in found})
+            if now - self._flushed_at > ACCESS_FLUSH_INTERVAL:
+                self._flush_access(conn)
+                conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        entries = dict(zip(keys, vectors))
+        if not entries:
+            return
+        entries = dict(list(entries.items())[-self.max_entries :])
+        with self.lock, closing(self._connect()) as conn:
+            # take the write lock up front, the slot allocation must not interleave
+            conn.execute("BEGIN IMMEDIATE")
+            # the eviction below must see the recent lookups
+            self._flush_access(conn)
+            slots: Dict[str, int] = {}
+            for i in range(0, len(entries), SQLITE_MAX_VARS):
+                chunk = list(entries)[i : i + SQLITE_MAX_VARS]
+                query = f"SELECT key, slot FROM embeddings WHERE key in ({','.join(['?'] * len(chunk))})"
+                slots.update(dict(conn.execute(query, chunk).fetchall()))
+            new_keys = [_ for _ in entries if _ not in slots]
+            now = time.time()
+            # refresh the entries being rewritten first so they are not evicted
+            conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, _) for _ in slots],
+            )
+            next_slot = conn.execute(
+                "SELECT COALESCE(MAX(slot) + 1, 0) FROM embeddings"
+            ).fetchone()[0]
+            free = list(range(next_slot, self.max_entries))[: len(new_keys)]
+            n_evict = len(new_keys) - len(free)
+            if n_evict > 0:
+                evicted = conn.execute(
+                    "SELECT key, slot FROM embeddings ORDER BY last_access ASC LIMIT ?",
+                    (n_evict,),
+                ).fetchall()
+                conn.executemany(
+                    "DELETE FROM embeddings WHERE key = ?", [(_[0],) for _ in evicted]
+                )
+                free.extend([_[1] for _ in evicted])
+                self.evictions += len(evicted)
+            for key, slot in zip(new_keys, free):
+                slots[key] = slot
+            for key, slot in slots.items():
+                self.tags[slot] = 0
+                self.vectors[slot] = np.asarray(entries[key], dtype=np.float32)
+                self.tags[slot] = self._tag(key)
+            self.vectors.flush()
+            self.tags.flush()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, slot, last_access) VALUES (?, ?, ?)",
+                [(key, slot, now) for key, slot in slots.items()],
+            )
+            conn.commit()
+
+    def stats(self) -> Dict[str, int | float]:
+        with closing(self._connect()) as conn:
+            size = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,55 +1,246 @@
+import asyncio
+import os
+import threading
 import time
-from functools import lru_cache
-from typing import List
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Iterator, List
 
-import torch.nn.functional as F
+import numpy as np
 from langchain_core.embeddings import Embeddings
-from torch import Tensor
-from transformers import AutoModel, AutoTokenizer
 
-from bao import MODEL_CACHE
+from bao import MODEL_PATH
 from bao.settings.settings import settings
+from bao.utils.embedding_backends import (
+    EmbeddingBackend,
+    encode_in_worker,
+    init_worker,
+    length_buckets,
+    load_backend,
+    load_tokenizer,
+    token_lengths,
+)
+from bao.utils.embedding_batcher import EmbeddingBatcher
+from bao.utils.embedding_store import EmbeddingStore
+from bao.utils.query_vector_cache import QueryVectorCache, normalize_query
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def average_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
-    last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
-    return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
-
-
 class EmbeddingsCache(Embeddings):
     def __init__(self) -> None:
         super().__init__()
         self.model_id = settings().local.embedding_hf_model_name
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, cache_dir=MODEL_CACHE)  # type: ignore
-        self.model = AutoModel.from_pretrained(self.model_id, cache_dir=MODEL_CACHE)  # type: ignore
         self.embedding_max_tokens = settings().local.embedding_hf_model_tokens
+        # the model is loaded on first use or by warmup()
+        self._backend: EmbeddingBackend | None = None
+        self._backend_lock = threading.Lock()
+        self._ready = False
+        self.batcher = None
+        if settings().embedding.batch_max_wait_ms > 0:
+            self.batcher = EmbeddingBatcher(
+                self.inference,
+                max_batch_size=settings().embedding.batch_max_size,
+                max_wait_ms=settings().embedding.batch_max_wait_ms,
+            )
+        # model inference of the async api runs here, never on the event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings().embedding.async_workers,
+            thread_name_prefix="embedding",
+        )
+        # the worker processes only run inside worker_processes(), e.g. the folder ingestion
+        self._pool: ProcessPoolExecutor | None = None
+        self._pool_lock = threading.Lock()
+        self._bulk_jobs = 0
+        self._tokenizer: Any = None
+        # vectors of different backends are not interchangeable
+        self.store_model_id = f"{self.model_id}@{settings().local.embedding_backend}"
+        store_root = settings().embedding.store_path or MODEL_PATH / "embedding_store"
+        self.store = None
+        if settings().embedding.store_enabled:
+            self.store = EmbeddingStore(
+                root=store_root,
+                dim=settings().embedding.embedding_size,
+                max_entries=settings().embedding.store_max_entries,
+            )
+        shared_query_store = None
+        if settings().embedding.query_cache_shared:
+            shared_query_store = EmbeddingStore(
+                root=store_root,
+                dim=settings().embedding.embedding_size,
+                max_entries=settings().embedding.query_cache_shared_max_entries,
+                namespace="query",
+            )
+        self.query_cache = QueryVectorCache(
+            model_id=self.store_model_id,
+            max_bytes=settings().embedding.query_cache_max_bytes,
+            ttl=settings().embedding.query_cache_ttl,
+            shared=shared_query_store,
+        )
 
-    def inference(self, texts: List[str]) -> List[List[float]]:
+    @property
+    def backend(self) -> EmbeddingBackend:
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = load_backend(
+                        settings().local.embedding_backend, self.model_id, self.embedding_max_tokens  # type: ignore
+                    )
+        return self._backend
+
+    @property
+    def is_ready(self) -> bool:
+        """True once the model is loaded and warmed up"""
+        return self._ready
+
+    def warmup(self) -> None:
+        """Load the model and run a dummy batch, so that the first request does not pay for it"""
+        time_st = time.time()
+        try:
+            self.backend.encode(["query: warm up", "passage: warm up the embedding model"])
+        except Exception:
+            logger.exception("failed to warm up the embedding model")
+            raise
+        self._ready = True
+        logger.info(f"Embedding model is ready. Warm-up took {time.time() - time_st:0.3f}")
+
+    def mark_ready(self) -> None:
+        """Take traffic without the warm-up, the model is then loaded by the first request"""
+        self._ready = True
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Small requests are merged with other in-flight requests by the batcher.
+        Requests that already fill a batch are embedded in length buckets.
+        """
+        if len(texts) >= settings().embedding.batch_max_size:
+            return self._embed_bulk(texts)
+        if self.batcher is None:
+            return self.inference(texts)
+        return self.batcher.embed(texts)  # type: ignore
+
+    def _worker_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is not None:
+                return self._pool
+            count_workers = settings().embedding.count_workers
+            num_threads = settings().embedding.worker_threads or max(
+                1, (os.cpu_count() or 1) // count_workers
+            )
+            logger.info(
+                f"Starting {count_workers} embedding workers with {num_threads} torch threads each"
+            )
+            # spawn: forked torch thread pools are not safe to reuse
+            self._pool = ProcessPoolExecutor(
+                max_workers=count_workers,
+                mp_context=get_context("spawn"),
+                initializer=init_worker,
+                initargs=(
+                    settings().local.embedding_backend,
+                    self.model_id,
+                    self.embedding_max_tokens,
+                    num_threads,
+                ),
+            )
+        return self._pool
+
+    @contextmanager
+    def worker_processes(self) -> Iterator[None]:
+        """
+        Embed the bulk requests on count_workers processes within the block.
+        The processes are started on first use and stopped at the end of the block.
+        """
+        with self._pool_lock:
+            self._bulk_jobs += 1
+        try:
+            yield
+        finally:
+            with self._pool_lock:
+                self._bulk_jobs -= 1
+                pool = self._pool if self._bulk_jobs == 0 else None
+                if pool is not None:
+                    self._pool = None
+            if pool is not None:
+                logger.info("Stopping the embedding workers")
+                pool.shutdown()
+
+    def _token_lengths(self, texts: List[str]) -> List[int]:
+        """Token lengths by the tokenizer alone, the model is not loaded when the workers encode"""
+        if self._backend is not None:
+            return self._backend.token_lengths(texts)
+        with self._backend_lock:
+            if self._tokenizer is None:
+                self._tokenizer = load_tokenizer(self.model_id)
+        return token_lengths(self._tokenizer, texts, self.embedding_max_tokens)
+
+    def _embed_bulk(self, texts: List[str]) -> List[List[float]]:
+        """
+        Sort the texts by token length into buckets to avoid padding short texts to the longest one,
+        embed the buckets on the worker processes if running and restore the original order.
+        """
+        use_workers = settings().embedding.count_workers > 1 and self._bulk_jobs > 0
+        buckets = length_buckets(
+            self._token_lengths(texts) if use_workers else self.backend.token_lengths(texts),
+            max_size=settings().embedding.batch_max_size,
+            max_tokens=settings().embedding.bucket_max_tokens,
+        )
+        bucket_texts = [[texts[i] for i in bucket] for bucket in buckets]
         time_st = time.time()
-        batch_dict = self.tokenizer(
-            texts,
-            max_length=self.embedding_max_tokens,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
+        if use_workers:
+            bucket_vectors = list(self._worker_pool().map(encode_in_worker, bucket_texts))
+        else:
+            bucket_vectors = [self.backend.encode(_) for _ in bucket_texts]
+        logger.info(
+            f"Elapsed time for embedding {len(texts)} texts in {len(buckets)} buckets: {time.time() - time_st:0.3f}"
         )
-        outputs = self.model(**batch_dict)
-        embeddings = average_pool(
-            outputs.last_hidden_state, batch_dict["attention_mask"]  # type: ignore
+        embeddings = np.empty(
+            (len(texts), settings().embedding.embedding_size), dtype=np.float32
+        )
+        for bucket, vectors in zip(buckets, bucket_vectors):
+            embeddings[bucket] = vectors
+        return embeddings  # type: ignore
+
+    def inference(self, texts: List[str]) -> List[List[float]]:
+        time_st = time.time()
+        embeddings = self.backend.encode(texts)
+        logger.info(
+            f"Elapsed time for embedding {len(texts)} texts: {time.time() - time_st:0.3f}"
         )
-        embeddings = F.normalize(embeddings, p=2, dim=1)
-        logger.info(f"Elapsed time for query embedding: {time.time() - time_st:0.3f}")
-        return embeddings.detach().cpu().numpy()
+        return embeddings  # type: ignore
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         # Tokenize the input texts
         texts = ["passage: " + _ for _ in texts]
-        return self.inference(texts)
+        if self.store is None:
+            return self._embed(texts)
+        keys = [self.store.key(self.store_model_id, _) for _ in texts]
+        vectors = self.store.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in vectors]
+        if missing:
+            embeddings = self._embed([texts[i] for i in missing])
+            self.store.put_many([keys[i] for i in missing], embeddings)
+            vectors.update({keys[i]: v for i, v in zip(missing, embeddings)})
+        logger.info(
+            f"embedding store: {len(texts) - len(missing)} hits, {len(missing)} misses"
+        )
+        return np.stack([vectors[_] for _ in keys])  # type: ignore
 
-    @lru_cache(maxsize=1000)
     def embed_query(self, text: str) -> List[float]:
-        text = "query: " + text
-        return self.inference([text])[0]
+        vector = self.query_cache.get(text)
+        if vector is not None:
+            return vector  # type: ignore
+        vector = self._embed(["query: " + normalize_query(text)])[0]
+        self.query_cache.put(text, vector)  # type: ignore
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.embed_documents, texts
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.embed_query, text
+        )
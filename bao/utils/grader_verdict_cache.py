@@ -0,0 +1,90 @@
+import hashlib
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SQLITE_MAX_VARS = 500
+# seconds between two purges of the expired verdicts
+PURGE_INTERVAL = 600
+
+
+class GraderVerdictCache:
+    """
+    Persistent cache of the grader verdicts of (question, chunk) pairs, with TTL.
+    Chunks are identified by the hash of their text, so a re-ingested chunk with a new text misses.
+    Entries remember the source of the chunk to be dropped when the source is removed.
+    """
+
+    def __init__(self, db_root: str, ttl: Optional[float] = None) -> None:
+        Path(db_root).mkdir(parents=True, exist_ok=True)
+        self.db_file = Path(db_root) / "grader_verdicts.sqlite"
+        self.ttl = ttl
+        self._purged_at = 0.0
+        with closing(self._connect()) as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS verdicts (
+                key TEXT PRIMARY KEY,
+                source TEXT,
+                verdict TEXT,
+                expire_at REAL
+            )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_source ON verdicts (source)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_expire_at ON verdicts (expire_at)"
+            )
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    @staticmethod
+    def key(question: str, chunk: str, model: str, template_hash: str) -> str:
+        chunk_hash = hashlib.sha256(chunk.encode()).hexdigest()
+        return hashlib.sha256(
+            f"{question}\x00{chunk_hash}\x00{model}\x00{template_hash}".encode()
+        ).hexdigest()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(set(keys))
+        found: Dict[str, str] = {}
+        now = time.time()
+        with closing(self._connect()) as conn:
+            for i in range(0, len(keys), SQLITE_MAX_VARS):
+                chunk = keys[i : i + SQLITE_MAX_VARS]
+                query = f"SELECT key, verdict FROM verdicts WHERE expire_at > ? and key in ({','.join(['?'] * len(chunk))})"
+                found.update(dict(conn.execute(query, (now, *chunk)).fetchall()))
+        return found
+
+    def put_many(self, entries: List[Tuple[str, str, str]]) -> None:
+        """entries: (key, source, verdict)"""
+        if not entries:
+            return
+        now = time.time()
+        expire_at = now + self.ttl if self.ttl else float("inf")
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO verdicts (key, source, verdict, expire_at) VALUES (?, ?, ?, ?)",
+                [(key, source, verdict, expire_at) for key, source, verdict in entries],
+            )
+            if now - self._purged_at >= PURGE_INTERVAL:
+                # expired verdicts are never read, drop them once in a while
+                self._purged_at = now
+                conn.execute("DELETE FROM verdicts WHERE expire_at <= ?", (now,))
+            conn.commit()
+
+    def remove_sources(self, sources: Iterable[str]) -> None:
+        sources = list(set(sources))
+        with closing(self._connect()) as conn:
+            for i in range(0, len(sources), SQLITE_MAX_VARS):
+                chunk = sources[i : i + SQLITE_MAX_VARS]
+                query = f"DELETE FROM verdicts WHERE source in ({','.join(['?'] * len(chunk))})"
+                conn.execute(query, chunk)
+            conn.commit()
+
+    def clear(self) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM verdicts")
+            conn.commit()
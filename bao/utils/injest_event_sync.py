@@ -1,16 +1,27 @@
 import logging
 import sqlite3
+import threading
+import time
 from contextlib import closing
 from pathlib import Path
-from typing import Iterable, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 
 class InjestEventSync:
-    def __init__(self, db_root: str, sqllite_local: str = ".sqllite.injest") -> None:
+    def __init__(
+        self,
+        db_root: str,
+        sqllite_local: str = ".sqllite.injest",
+        head_check_interval: float = 0.0,
+    ) -> None:
         self.db_root = db_root
         self.sqllite_local = sqllite_local
+        self.head_check_interval = head_check_interval
+        # app name -> (last log id, looked up at)
+        self._heads: Dict[str, Tuple[int, float]] = {}
+        self._heads_lock = threading.Lock()
         with closing(sqlite3.connect(Path(db_root) / sqllite_local)) as conn:
             # Create a table (if it doesn't exist)
             conn.execute(
@@ -21,6 +32,17 @@ class InjestEventSync:
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )"""
             )
+            # append-only log of the changes of the vector db, read by the in-process replicas
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS injest_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                app_name TEXT,
+                op TEXT,
+                meta_key TEXT,
+                meta_value TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )"""
+            )
             conn.commit()
 
     def batch_insert_event(self, app_name: str, entry_names: List[str]) -> None:
@@ -90,3 +112,44 @@ class InjestEventSync:
             res = cursor.fetchall()
             cursor.close()
             return res
+
+    def append_log(
+        self, app_name: str, op: str, meta_key: str, meta_values: Iterable[str]
+    ) -> int:
+        """
+        Record that the points with metadata `meta_key` in `meta_values` were upserted or removed.
+        Returns the id of the last log record.
+        """
+        with closing(sqlite3.connect(Path(self.db_root) / self.sqllite_local)) as conn:
+            conn.executemany(
+                "INSERT INTO injest_log (app_name, op, meta_key, meta_value) VALUES (?, ?, ?, ?)",
+                [(app_name, op, meta_key, _) for _ in set(meta_values)],
+            )
+            conn.commit()
+        log_id = self.last_log_id(app_name)
+        with self._heads_lock:
+            self._heads[app_name] = (log_id, time.monotonic())
+        return log_id
+
+    def last_log_id(self, app_name: str) -> int:
+        with closing(sqlite3.connect(Path(self.db_root) / self.sqllite_local)) as conn:
+            query = "SELECT COALESCE(MAX(id), 0) FROM injest_log WHERE app_name = ?"
+            return conn.execute(query, (app_name,)).fetchone()[0]
+
+    def head(self, app_name: str) -> int:
+        """The last log id, looked up at most every head_check_interval seconds"""
+        now = time.monotonic()
+        with self._heads_lock:
+            cached = self._heads.get(app_name)
+        if cached is not None and now - cached[1] < self.head_check_interval:
+            return cached[0]
+        log_id = self.last_log_id(app_name)
+        with self._heads_lock:
+            self._heads[app_name] = (log_id, now)
+        return log_id
+
+    def log_since(self, app_name: str, log_id: int) -> List[Tuple[int, str, str, str]]:
+        """Log records after `log_id`: (id, op, meta_key, meta_value)"""
+        with closing(sqlite3.connect(Path(self.db_root) / self.sqllite_local)) as conn:
+            query = "SELECT id, op, meta_key, meta_value FROM injest_log WHERE app_name = ? and id > ? order by id"
+            return conn.execute(query, (app_name, log_id)).fetchall()
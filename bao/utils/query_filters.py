@@ -0,0 +1,94 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from bao.components.injest import (
+    PUB_DATE_KEY,
+    PUB_YEAR_KEY,
+    PUB_YEAR_MONTH_KEY,
+    VIDEO_KEY,
+)
+from bao.utils.strings import date_from_yyyy, date_from_yyyymm, date_from_yyyymmdd
+
+# a link ends before whitespace or full-width punctuation, trailing ascii punctuation is stripped
+URL_REGEX = re.compile(r"https?://[^\s\u3000-\u303f\uff00-\uffef]+")
+URL_TRAILING_PUNCTUATION = ".,;:!?'\")]}>"
+# 2024-05-01, 2024/5/1, 2024.05.01, 20240501, 2024年5月1日
+DATE_REGEX = re.compile(
+    r"(?<!\d)((?:19|20)\d{2})(?:([-/.])(\d{1,2})\2(\d{1,2})|(\d{2})(\d{2})|年(\d{1,2})月(\d{1,2})[日号]?)(?!\d)"
+)
+# 2024-05, 2024/5, 2024年5月
+YEAR_MONTH_REGEX = re.compile(r"(?<!\d)((?:19|20)\d{2})(?:[-/.](\d{1,2})|年(\d{1,2})月)(?!\d)")
+# in 2024, published 2024, published in 2024, 2024年. A bare year is left in the query
+YEAR_REGEX = re.compile(
+    r"\b(?:published(?:\s+in)?|in)\s+((?:19|20)\d{2})(?!\d)|(?<!\d)((?:19|20)\d{2})年",
+    re.IGNORECASE,
+)
+
+
+def video_url(
+    url: str,
+    youtube_url_domain: str = "https://www.youtube.com",
+    youtube_short_url_domain: str = "https://youtu.be",
+) -> str:
+    """The link as stored in the video metadata: youtube links as the watch url of the video id"""
+    url = url.rstrip(URL_TRAILING_PUNCTUATION)
+    youtube_vid = ""
+    if url.startswith(youtube_url_domain) and "v=" in url:
+        youtube_vid = url.split("v=")[-1].split("&")[0]
+    elif url.startswith(youtube_short_url_domain):
+        youtube_vid = url.split("/")[-1].split("?")[0]
+    if youtube_vid:
+        return f"{youtube_url_domain}/watch?v={youtube_vid}"
+    return url
+
+
+def parse_query_filters(
+    question: str,
+    topic_keywords: Optional[Dict[str, List[str]]] = None,
+    youtube_url_domain: str = "https://www.youtube.com",
+    youtube_short_url_domain: str = "https://youtu.be",
+) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Local counterpart of the query rewrite for search mode:
+    the metadata filters in the question (video link, publish date, month or year),
+    the question without them as the query, and the topic of the first matched keyword.
+    """
+    query_rewrite: Dict[str, Any] = {}
+    url = URL_REGEX.search(question)
+    if url:
+        link = url.group(0).rstrip(URL_TRAILING_PUNCTUATION)
+        query_rewrite[VIDEO_KEY] = video_url(
+            link, youtube_url_domain, youtube_short_url_domain
+        )
+        question = question[: url.start()] + " " + question[url.start() + len(link) :]
+    date = DATE_REGEX.search(question)
+    year_month = YEAR_MONTH_REGEX.search(question)
+    year = YEAR_REGEX.search(question)
+    if date:
+        yyyy = date.group(1)
+        mm = date.group(3) or date.group(5) or date.group(7)
+        dd = date.group(4) or date.group(6) or date.group(8)
+        value = date_from_yyyymmdd(f"{yyyy}{int(mm):02d}{int(dd):02d}")
+        if value:
+            query_rewrite[PUB_DATE_KEY] = value
+            question = question.replace(date.group(0), " ")
+    elif year_month:
+        mm = year_month.group(2) or year_month.group(3)
+        value = date_from_yyyymm(f"{year_month.group(1)}{int(mm):02d}")
+        if value:
+            query_rewrite[PUB_YEAR_MONTH_KEY] = value
+            question = question.replace(year_month.group(0), " ")
+    elif year:
+        value = date_from_yyyy(year.group(1) or year.group(2))
+        if value:
+            query_rewrite[PUB_YEAR_KEY] = value
+            question = question.replace(year.group(0), " ")
+    query_rewrite["query"] = " ".join(question.split())
+
+    topic = None
+    lowered = query_rewrite["query"].lower()
+    for name, keywords in (topic_keywords or {}).items():
+        if any([_.lower() in lowered for _ in keywords]):
+            topic = name
+            break
+    return query_rewrite, topic
@@ -0,0 +1,108 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from bao.utils.embedding_store import EmbeddingStore
+
+
+def normalize_query(text: str) -> str:
+    """
+    Collapse whitespaces, so that the same question shares one vector.
+    The case is kept: it is the text the vector is embedded from.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class QueryVectorCache:
+    """
+    In-process LRU cache of query vectors bounded by bytes, with TTL.
+    An optional shared tier (an on-disk EmbeddingStore) lets several worker processes
+    reuse the vectors of each other.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_bytes: int,
+        ttl: Optional[float] = None,
+        shared: Optional[EmbeddingStore] = None,
+    ) -> None:
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.bytes = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = normalize_query(text)
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, expire_at = entry
+                if expire_at >= time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                self._remove(key)
+                self.expirations += 1
+        if self.shared is not None:
+            store_key = self.shared.key(self.model_id, key)
+            vector = self.shared.get_many([store_key]).get(store_key)
+            if vector is not None:
+                with self.lock:
+                    self.shared_hits += 1
+                self._put_local(key, vector)
+                return vector
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, text: str, vector: np.ndarray) -> None:
+        key = normalize_query(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._put_local(key, vector)
+        if self.shared is not None:
+            self.shared.put_many([self.shared.key(self.model_id, key)], [vector])
+
+    def _put_local(self, key: str, vector: np.ndarray) -> None:
+        if vector.nbytes > self.max_bytes:
+            return
+        expire_at = time.time() + self.ttl if self.ttl else float("inf")
+        with self.lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (vector, expire_at)
+            self.bytes += vector.nbytes
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        vector, _ = self._entries.pop(key)
+        self.bytes -= vector.nbytes
+
+    def stats(self) -> Dict[str, int | float]:
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from bao.utils.query_vector_cache import normalize_query
+
+# ranked search hits: (point id, collection name, score)
+Hits = List[Tuple[str, str, float]]
+
+
+class RetrievalCache:
+    """
+    In-process LRU cache of ranked search hits, keyed by the search params.
+    Every entry remembers the collection generation it was searched at,
+    an entry of an older generation is a miss: the collection changed since.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[str, Tuple[int, float, Hits]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        query: str, filter: Optional[Dict[str, Any]], k: int, score_threshold: float
+    ) -> str:
+        return json.dumps(
+            [normalize_query(query or ""), filter or {}, k, score_threshold],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+
+    def get(self, key: str, generation: int) -> Optional[Hits]:
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expire_at, hits = entry
+                if entry_generation == generation and expire_at >= time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return hits
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key: str, generation: int, hits: Hits) -> None:
+        expire_at = time.time() + self.ttl if self.ttl else float("inf")
+        with self.lock:
+            self._entries[key] = (generation, expire_at, hits)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int | float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
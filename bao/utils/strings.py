@@ -150,3 +150,27 @@ def date_from_yyyy(date_val: Union[str, int]) -> str:
         except:
             return ""
     return date_val
+
+
+CJK_REGEX = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of an LLM tokenizer, without loading one:
+    a token per CJK character, a token per 4 other characters.
+    """
+    n_cjk = len(CJK_REGEX.findall(text))
+    return n_cjk + (len(text) - n_cjk + 3) // 4
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut the text to about `max_tokens`, see estimate_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for i, char in enumerate(text):
+        used += 4 if CJK_REGEX.match(char) else 1
+        if used > max_tokens * 4:
+            return text[:i]
+    return text
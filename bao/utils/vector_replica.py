@@ -0,0 +1,161 @@
+import logging
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _Snapshot(NamedTuple):
+    ids: np.ndarray
+    matrix: np.ndarray
+    # per-row dequantization scale of the int8 matrix
+    scales: Optional[np.ndarray]
+    payloads: List[Dict[str, Any]]
+    collections: np.ndarray
+    # metadata columns built on first use by the filter masks
+    columns: Dict[str, np.ndarray]
+
+
+class VectorReplica:
+    """
+    In-process copy of a vector collection: one contiguous matrix of the normalized vectors
+    (float32, or int8 with a per-row scale) with a vectorized top-k,
+    and the payload metadata kept as columns for the filter masks.
+    Updates build new arrays and swap them in, so searches never wait for a refresh.
+    """
+
+    def __init__(self, dim: int, metadata_key: str, dtype: str = "float32") -> None:
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Not support replica dtype: {dtype}")
+        self.dim = dim
+        self.metadata_key = metadata_key
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self._snapshot = self._build([], np.empty((0, dim), np.float32), [], [])
+
+    def __len__(self) -> int:
+        return len(self._snapshot.ids)
+
+    def _build(
+        self,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        payloads: List[Dict[str, Any]],
+        collections: Sequence[str],
+    ) -> _Snapshot:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        scales = None
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            vectors = np.round(vectors / scales[:, None]).astype(np.int8)
+        return _Snapshot(
+            ids=np.array(ids, dtype=object),
+            matrix=vectors,
+            scales=scales,
+            payloads=list(payloads),
+            collections=np.array(collections, dtype=object),
+            columns={},
+        )
+
+    def _vectors(self, snapshot: _Snapshot) -> np.ndarray:
+        if snapshot.scales is None:
+            return snapshot.matrix
+        return snapshot.matrix.astype(np.float32) * snapshot.scales[:, None]
+
+    def _column(self, snapshot: _Snapshot, key: str) -> np.ndarray:
+        if key not in snapshot.columns:
+            snapshot.columns[key] = np.array(
+                [(_.get(self.metadata_key) or {}).get(key) for _ in snapshot.payloads],
+                dtype=object,
+            )
+        return snapshot.columns[key]
+
+    @staticmethod
+    def _isin(column: np.ndarray, values: Sequence[Any]) -> np.ndarray:
+        values = set(values)
+        return np.fromiter((_ in values for _ in column), dtype=bool, count=len(column))
+
+    def _mask(
+        self, snapshot: _Snapshot, filter: Optional[Dict[str, Any]]
+    ) -> np.ndarray:
+        """Rows matching all the `metadata.key == value` conditions of the filter"""
+        mask = np.ones(len(snapshot.ids), dtype=bool)
+        for key, value in (filter or {}).items():
+            if isinstance(value, dict):
+                raise ValueError(f"nested filter on {key} is not supported by the replica")
+            column = self._column(snapshot, key)
+            if isinstance(value, list):
+                mask &= self._isin(column, value)
+            else:
+                mask &= column == value
+        return mask
+
+    def load(
+        self,
+        ids: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+        payloads: List[Dict[str, Any]],
+        collections: Sequence[str],
+    ) -> None:
+        """Replace the whole replica"""
+        snapshot = self._build(ids, np.asarray(vectors), payloads, collections)
+        with self.lock:
+            self._snapshot = snapshot
+
+    def update(
+        self,
+        remove: Dict[str, List[Any]],
+        ids: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+        payloads: List[Dict[str, Any]],
+        collections: Sequence[str],
+    ) -> None:
+        """Drop the rows whose metadata match `remove` ({key: values}), then add the given points"""
+        with self.lock:
+            snapshot = self._snapshot
+            keep = ~self._isin(snapshot.ids, ids)
+            for key, values in remove.items():
+                keep &= ~self._isin(self._column(snapshot, key), values)
+            kept = np.flatnonzero(keep)
+            self._snapshot = self._build(
+                [*snapshot.ids[kept], *ids],
+                np.concatenate(
+                    [
+                        self._vectors(snapshot)[kept],
+                        np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim),
+                    ]
+                ),
+                [snapshot.payloads[i] for i in kept] + list(payloads),
+                [*snapshot.collections[kept], *collections],
+            )
+
+    def search(
+        self,
+        vector: Sequence[float],
+        k: int,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Tuple[str, float, Dict[str, Any], str]]:
+        """Top k rows by cosine similarity: (point id, score, payload, collection name)"""
+        snapshot = self._snapshot
+        mask = self._mask(snapshot, filter)
+        k = min(k, int(mask.sum()))
+        if k <= 0:
+            return []
+        scores = snapshot.matrix @ np.asarray(vector, dtype=np.float32)
+        if snapshot.scales is not None:
+            scores *= snapshot.scales
+        scores = np.where(mask, scores, -np.inf)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                snapshot.ids[i],
+                float(scores[i]),
+                snapshot.payloads[i],
+                snapshot.collections[i],
+            )
+            for i in top
+        ]
@@ -37,25 +37,10 @@ class IngestUI:
         return self.ingestor.list_sources(title_like=self.filter_text)
 
     def _upload(self, files: List[str]) -> None:
-        file_paths = [Path(_) for _ in files]
-        file_names = [_.name for _ in file_paths]
-        # (entry data: dict, index)
-        valid_sources = [
-            (self.ingestor._load_entry(_), i) for i, _ in enumerate(file_paths)
-        ]
-        # (source, path_index)
-        valid_sources = [
-            (_[0].get(SOURCE_KEY, file_names[_[1]]), _[1])
-            for _ in valid_sources
-            if _ is not None
-        ]
-        # first batch remove
-        self.ingestor.remove(
-            source_key=SOURCE_KEY, source_values=[_[0] for _ in valid_sources]
-        )
-        # then insert
-        for _, i_path in valid_sources:
-            self.ingestor.injest_file(file_paths[i_path])
+        # re-ingestion is an idempotent upsert: no need to remove the sources first
+        for file_path in [Path(_) for _ in files]:
+            if self.ingestor._load_entry(file_path) is not None:
+                self.ingestor.injest_file(file_path)
 
     def _select_source(self, select_data: gr.SelectData):
         self.selected_source = select_data.value
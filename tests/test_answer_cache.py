@@ -0,0 +1,89 @@
+import time
+
+from bao.components.injest import SOURCE_KEY
+from bao.utils.answer_cache import AnswerCache
+
+FILTER = AnswerCache.filter_key(None, 4)
+
+
+def cache(ttl=None) -> AnswerCache:
+    cache = AnswerCache(max_entries=10, ttl=ttl)
+    cache.log_id = 0
+    return cache
+
+
+def put(cache: AnswerCache, vector, answer: str, sources, log_id=0) -> None:
+    cache.put(vector, FILTER, {"output_text": answer}, sources, log_id)
+
+
+def answer(cache: AnswerCache, vector):
+    found = cache.get(vector, FILTER, 0.99)
+    return None if found is None else found[1]["output_text"]
+
+
+def test_get_by_similarity_and_filter():
+    c = cache()
+    put(c, [1, 0], "a", ["a.yaml"])
+    assert answer(c, [2, 0]) == "a"
+    assert answer(c, [0, 1]) is None
+    assert c.get([1, 0], AnswerCache.filter_key({"topic": "bao"}, 4), 0.99) is None
+
+
+def test_sync_drops_the_answers_citing_a_changed_source():
+    c = cache()
+    put(c, [1, 0], "a", ["a.yaml"])
+    put(c, [0, 1], "b", ["b.yaml", "c.yaml"])
+    c.sync([(1, "upsert", SOURCE_KEY, "c.yaml")], SOURCE_KEY)
+    assert answer(c, [1, 0]) == "a"
+    assert answer(c, [0, 1]) is None
+    assert c.log_id == 1
+    assert c.stats()["invalidations"] == 1
+
+
+def test_sync_clears_all_on_other_keys():
+    c = cache()
+    put(c, [1, 0], "a", ["a.yaml"])
+    put(c, [0, 1], "b", ["b.yaml"])
+    c.sync(
+        [(1, "upsert", SOURCE_KEY, "c.yaml"), (2, "remove", "video", "https://x")],
+        SOURCE_KEY,
+    )
+    assert answer(c, [1, 0]) is None
+    assert answer(c, [0, 1]) is None
+    assert c.log_id == 2
+
+
+def test_sync_without_records_keeps_the_log_id():
+    c = cache()
+    put(c, [1, 0], "a", ["a.yaml"])
+    c.sync([], SOURCE_KEY)
+    assert c.log_id == 0
+    assert answer(c, [1, 0]) == "a"
+
+
+def test_put_after_the_log_moved_is_rejected():
+    c = cache()
+    # looked up at log id 0, the source changed while answering
+    c.sync([(1, "upsert", SOURCE_KEY, "a.yaml")], SOURCE_KEY)
+    put(c, [1, 0], "a", ["a.yaml"], log_id=0)
+    assert answer(c, [1, 0]) is None
+    put(c, [1, 0], "a", ["a.yaml"], log_id=1)
+    assert answer(c, [1, 0]) == "a"
+
+
+def test_ttl():
+    c = cache(ttl=0.05)
+    put(c, [1, 0], "a", ["a.yaml"])
+    assert answer(c, [1, 0]) == "a"
+    time.sleep(0.1)
+    assert answer(c, [1, 0]) is None
+    assert c.stats()["entries"] == 0
+
+
+def test_max_entries_drops_the_oldest():
+    c = AnswerCache(max_entries=1)
+    c.log_id = 0
+    put(c, [1, 0], "a", ["a.yaml"])
+    put(c, [0, 1], "b", ["b.yaml"])
+    assert answer(c, [1, 0]) is None
+    assert answer(c, [0, 1]) == "b"
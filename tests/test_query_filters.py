@@ -0,0 +1,95 @@
+import pytest
+
+from bao.components.injest import (
+    PUB_DATE_KEY,
+    PUB_YEAR_KEY,
+    PUB_YEAR_MONTH_KEY,
+    VIDEO_KEY,
+)
+from bao.utils.query_filters import parse_query_filters, video_url
+
+
+@pytest.mark.parametrize(
+    "question, key, value, query",
+    [
+        ("news of 2024-05-01", PUB_DATE_KEY, "20240501", "news of"),
+        ("news of 2024/5/1", PUB_DATE_KEY, "20240501", "news of"),
+        ("20240501 news", PUB_DATE_KEY, "20240501", "news"),
+        ("2024年5月1日的视频", PUB_DATE_KEY, "20240501", "的视频"),
+        ("talks of 2024-05", PUB_YEAR_MONTH_KEY, "202405", "talks of"),
+        ("2024年5月讲了什么", PUB_YEAR_MONTH_KEY, "202405", "讲了什么"),
+        ("videos published in 2023", PUB_YEAR_KEY, "2023", "videos"),
+        ("Published 2021 talks", PUB_YEAR_KEY, "2021", "talks"),
+        ("what was said in 2019", PUB_YEAR_KEY, "2019", "what was said"),
+        ("2024年的视频", PUB_YEAR_KEY, "2024", "的视频"),
+    ],
+)
+def test_dates(question, key, value, query):
+    query_rewrite, _ = parse_query_filters(question)
+    assert query_rewrite == {key: value, "query": query}
+
+
+@pytest.mark.parametrize(
+    "question", ["iphone 2000 sales", "the 2008 financial crisis", "top 1999 hits"]
+)
+def test_bare_year_is_kept_in_the_query(question):
+    query_rewrite, _ = parse_query_filters(question)
+    assert query_rewrite == {"query": question}
+
+
+@pytest.mark.parametrize(
+    "question, video, query",
+    [
+        (
+            "summarize https://www.youtube.com/watch?v=abc123&t=10s, please",
+            "https://www.youtube.com/watch?v=abc123",
+            "summarize , please",
+        ),
+        (
+            "summarize https://youtu.be/abc123?si=xyz.",
+            "https://www.youtube.com/watch?v=abc123",
+            "summarize .",
+        ),
+        (
+            "看看https://youtu.be/abc123，讲了什么",
+            "https://www.youtube.com/watch?v=abc123",
+            "看看 ，讲了什么",
+        ),
+        ("(https://example.com/talk)", "https://example.com/talk", "( )"),
+    ],
+)
+def test_urls(question, video, query):
+    query_rewrite, _ = parse_query_filters(question)
+    assert query_rewrite == {VIDEO_KEY: video, "query": query}
+
+
+def test_video_url_of_custom_domains():
+    assert (
+        video_url("https://m.youtube.com/watch?v=abc123", "https://m.youtube.com")
+        == "https://m.youtube.com/watch?v=abc123"
+    )
+    assert video_url("https://example.com/watch?v=abc123") == (
+        "https://example.com/watch?v=abc123"
+    )
+
+
+def test_filters_and_keywords_together():
+    query_rewrite, topic = parse_query_filters(
+        "Miles videos published in 2022 https://youtu.be/abc123",
+        {"bao": ["bao"], "miles": ["miles"]},
+    )
+    assert query_rewrite == {
+        VIDEO_KEY: "https://www.youtube.com/watch?v=abc123",
+        PUB_YEAR_KEY: "2022",
+        "query": "Miles videos",
+    }
+    assert topic == "miles"
+
+
+def test_first_matched_keyword_wins():
+    _, topic = parse_query_filters(
+        "bao and miles", {"bao": ["BAO"], "miles": ["miles"]}
+    )
+    assert topic == "bao"
+    _, topic = parse_query_filters("nothing here", {"bao": ["bao"]})
+    assert topic is None
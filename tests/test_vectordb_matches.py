@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.documents import Document
+
+from bao.components.injest import PUB_YEAR_KEY, SOURCE_KEY, TOPIC_KEY
+from bao.components.vectordb import QdrantVectorDB, Shard
+
+
+def vectordb(sharding: str = "none") -> QdrantVectorDB:
+    """matches needs the topic shards and the settings only, no Qdrant client"""
+    db = QdrantVectorDB.__new__(QdrantVectorDB)
+    db.collection_name = "bao"
+    db.settings = SimpleNamespace(  # type: ignore
+        retriever=SimpleNamespace(sharding=sharding),
+        injest=SimpleNamespace(default_topic="bao"),
+    )
+    db.topic_shards = {}
+    if sharding == "collection":
+        db.topic_shards = {t: Shard(f"bao_{t}") for t in ("bao", "miles")}
+    return db
+
+
+def document(**metadata) -> Document:
+    return Document(page_content="", metadata=metadata)
+
+
+def test_no_filter_matches_all():
+    assert vectordb().matches(document(topic="bao"), None)
+    assert vectordb().matches(document(), {})
+
+
+@pytest.mark.parametrize(
+    "filter, expected",
+    [
+        ({PUB_YEAR_KEY: "2024"}, True),
+        ({PUB_YEAR_KEY: "2023"}, False),
+        ({PUB_YEAR_KEY: ["2023", "2024"]}, True),
+        ({PUB_YEAR_KEY: ["2022", "2023"]}, False),
+        ({PUB_YEAR_KEY: "2024", SOURCE_KEY: "a.yaml"}, True),
+        ({PUB_YEAR_KEY: "2024", SOURCE_KEY: "b.yaml"}, False),
+        ({TOPIC_KEY: "miles"}, False),
+    ],
+)
+def test_metadata_filter(filter, expected):
+    doc = document(**{PUB_YEAR_KEY: "2024", SOURCE_KEY: "a.yaml", TOPIC_KEY: "bao"})
+    assert vectordb().matches(doc, filter) is expected
+
+
+def test_topic_of_a_shard_matches_by_shard():
+    db = vectordb("collection")
+    assert db.matches(document(topic="miles"), {TOPIC_KEY: "miles"})
+    assert not db.matches(document(topic="bao"), {TOPIC_KEY: "miles"})
+    # documents without a known topic are written to the shard of the default topic
+    assert db.matches(document(topic="other_forms"), {TOPIC_KEY: "bao"})
+
+
+def test_topic_without_shard_searches_all_shards():
+    db = vectordb("collection")
+    assert db.matches(document(topic="bao"), {TOPIC_KEY: "federation"})
+    assert not db.matches(
+        document(topic="bao", **{PUB_YEAR_KEY: "2023"}),
+        {TOPIC_KEY: "federation", PUB_YEAR_KEY: "2024"},
+    )
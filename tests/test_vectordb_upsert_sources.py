@@ -0,0 +1,71 @@
+from typing import List
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from bao.components.injest import CHUNK_NO_KEY, SOURCE_KEY, TOPIC_KEY
+from bao.components.vectordb import QdrantVectorDB
+from bao.settings.settings import Settings, unsafe_settings
+from bao.settings.settings_loader import merge_settings
+
+
+@pytest.fixture
+def db(tmp_path) -> QdrantVectorDB:
+    """In-memory Qdrant with a collection per topic and the texts kept in the external store"""
+    settings = Settings(
+        **merge_settings(
+            [
+                unsafe_settings,
+                {
+                    "qdrant": {
+                        "path": None,
+                        "location": ":memory:",
+                        "collection": {
+                            "external_text": True,
+                            "text_store_path": str(tmp_path / "texts"),
+                        },
+                        "replica": {"enabled": False},
+                    },
+                    "retriever": {"sharding": "collection"},
+                    "injest": {"injest_from": str(tmp_path / "injest")},
+                },
+            ]
+        )
+    )
+    db = QdrantVectorDB(settings)
+    db.embeddings = DeterministicFakeEmbedding(size=settings.embedding.embedding_size)
+    return db
+
+
+def chunks(topic: str) -> List[Document]:
+    return [
+        Document(
+            page_content=f"chunk {i} of a.yaml",
+            metadata={SOURCE_KEY: "a.yaml", CHUNK_NO_KEY: i, TOPIC_KEY: topic},
+        )
+        for i in range(3)
+    ]
+
+
+def search(db: QdrantVectorDB, text: str, k: int = 10):
+    return db.search_with_score(db.embeddings.embed_query(text), k=k)
+
+
+def test_reingest_under_a_new_topic_keeps_the_texts(db):
+    db.upsert_sources(chunks("bao"))
+    db.upsert_sources(chunks("miles"))
+    assert len(search(db, "chunk")) == 3
+    for chunk in chunks("miles"):
+        document, _ = search(db, chunk.page_content, k=1)[0]
+        assert document.page_content == chunk.page_content
+        assert document.metadata[TOPIC_KEY] == "miles"
+
+
+def test_reingest_drops_the_removed_chunks(db):
+    db.upsert_sources(chunks("bao"))
+    db.upsert_sources(chunks("bao")[:2])
+    assert sorted([_.page_content for _, _score in search(db, "chunk")]) == [
+        "chunk 0 of a.yaml",
+        "chunk 1 of a.yaml",
+    ]